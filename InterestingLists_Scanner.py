@@ -12,9 +12,30 @@ import pandas as pd
 import math
 from adjustText import adjust_text # Used to label data points without overlap
 import os
+import json
+import base64
+import html
+import re
+import hashlib
+import bisect
+import shutil
+import threading
+import textwrap
+import queue
+import sys
+import pickle
+import subprocess
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import numpy as np
 from KTC_functions import KTC_GetGeneSet
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MaxNLocator
+try:
+    import pyarrow # Optional: much faster parsing of CSV/TSV files
+    has_pyarrow = True
+except ImportError:
+    has_pyarrow = False
 
 #%% Settings =================================================
 
@@ -22,9 +43,25 @@ from matplotlib.ticker import MaxNLocator
 # Input and Output
 # =============================================================================
 
-in_dir       = '/Volumes/kachrist/shares/cmgg_pnlab/Kasper/Data/Interesting_Lists' # Directory where all "Interesting lists" are located
+share_dir    = '/Volumes/kachrist/shares/cmgg_pnlab/Kasper/Data/Interesting_Lists' # Directory where all "Interesting lists" are located
+use_local_mirror = False # Keep a local copy of share_dir (only new and changed files are copied) and read from it instead of from the network share
+mirror_dir   = os.path.join(os.path.expanduser('~'), 'Interesting_Lists_mirror') # Directory of the local copy
+watch_mirror = False # With use_local_mirror: keep syncing in the background and re-read datasets whose files changed
+watch_interval = 300 # Seconds between syncs in watch mode
+in_dir       = mirror_dir if use_local_mirror else share_dir # Directory the lists are read from
 out_dir      = r'/Users/kachrist/Desktop/out_dir' #Directory where plots are saved
 path_pdf     = os.path.join(out_dir, 'InterestingLists.pdf') #Name of pdf file produced. Output directory is 
+path_html    = os.path.join(out_dir, 'InterestingLists.html') #Name of the interactive html report (if make_html)
+use_arrow_store = has_pyarrow # Keep the cleaned dataframes in an on-disk Arrow store. Later runs (and worker processes) memory-map them instead of re-reading in_dir
+store_dir       = os.path.join(out_dir, 'arrow_store') # Directory of the Arrow store. Delete it to force a full reload
+n_shards        = 1 # If more than 1, the scan is split over this many local processes (one per shard of the datasets) and their results merged into one report and pdf
+shard_by        = 'page' # 'page': all dataframes on a page of the pdf go to the same shard, 'dataset': dataframes are dealt out one by one
+shard_dir       = os.path.join(out_dir, 'shards') # Partial results of the shards
+# To split a run over cluster jobs instead, run this script once per shard with the environment variable IL_SHARD='<index>/<number of shards>'
+# (e.g. IL_SHARD=0/8 ... IL_SHARD=7/8) and then once with IL_MERGE=<number of shards> to merge the partial results into the report and the pdf.
+pipeline_stages = False # Overlap reading, scanning and plotting: dataframe N is plotted while N+1 is scanned and N+2 is read. Dataframes missing from the Arrow store are then read during the scan
+pipeline_depth  = 2 # With pipeline_stages: how many dataframes may wait between two stages. Together with pool_budget_mb this caps the memory used
+pool_budget_mb  = None # With the Arrow store: keep at most this many MB of dataframes in memory, re-loading evicted ones from the store when needed. None keeps all of them
 
 
 # =============================================================================
@@ -46,6 +83,25 @@ plot_legend       = True #Create legend for differential splicing plots (to iden
 plot_mean_value   = False #Create a yellow vertical line at the mean of all values on the 1st axis
 print_gene_names  = False #Print the names of events that clear the thresholds to the terminal
 make_pdf          = True #Create a pdf that contains all plots
+make_html         = False #Create a single html file (works offline) with a volcano per dataframe that shows the gene under the mouse, laid out in the pages of the pdf
+html_max_background = 5000 # Grey points per plot in the html report above which they are thinned out (on a grid, so outliers are kept). Highlighted points are all kept
+make_concordance_page = False #Correlate the effect sizes of every pair of datasets, save the table to out_dir and add a clustered heatmap page to the pdf
+concordance_method    = 'spearman' # 'spearman' or 'pearson'
+concordance_min_genes = 50 # Pairs of datasets that share fewer genes than this get no correlation
+run_enrichment        = False #Test the hits of every dataset (all significant genes, as printed in unbiased mode) for enrichment of the MSigDB gene sets in msigdb_dir
+enrichment_db_version = '2024.1.Hs' # MSigDB release to test (see get_gene_set below)
+enrichment_prefixes   = None # Only test the gene sets whose names start with one of these, e.g. ['HALLMARK_', 'REACTOME_']. None tests all gene sets of the release
+enrichment_set_sizes  = (10, 500) # Gene sets with fewer or more genes than this within a dataset's measured genes are not tested
+thresh_enrichment_FDR = 0.05 # Gene sets with an FDR below this are reported
+run_meta_analysis     = False #Combine the evidence for every gene across datasets (Stouffer's signed Z and Fisher's method) and save a ranked table to out_dir
+meta_datasets         = None # Dataframes (or pages of dict_pdf_layout) to combine. None combines all scanned dataframes
+meta_weights          = None # Weights for Stouffer's Z as {df_key: weight} (e.g. the square root of the number of samples). Dataframes not listed get weight 1. None weighs all equally
+meta_min_datasets     = 3 # Genes measured in fewer dataframes than this are left out of the table
+make_multiomic_pages  = False #For pages that combine RNA with proteomics and/or splicing: join their dataframes on gene, save the joined table to out_dir and add an RNA vs protein (or dPSI) scatter to the page
+genes_per_grid        = 20 # The NMDi rescue and Northwestern MS sections draw the replicates of this many genes per figure, as a grid of small plots. 0 draws one large figure per gene
+make_gene_cards       = False #Draw one forest plot per gene showing its effect in every dataset it was measured in, grouped by the pages of the pdf
+gene_card_genes       = None # Genes to draw gene cards for. None draws them for genes_of_interest
+gene_cards_per_page   = 12 # Gene cards per page of the pdf. More cards are spread over several pages ('Gene cards (1/n)', ...)
 #Colors for events for genes_of_interest and genes not of interest
 c_inte = '#4494c9' #blue
 c_nint = '#dedede' #grey
@@ -58,6 +114,32 @@ AS_colors   = {
 	'A5SS'  : '#0380fc'  #Blue
 		}
 
+# =============================================================================
+# Gene symbols
+# =============================================================================
+# Gene symbols are matched case-insensitively and after mapping aliases and legacy symbols to one canonical symbol, both in genes_of_interest and in the data.
+# If path_gene_aliases exists (a tab-separated custom download from genenames.org with the columns 'Approved symbol', 'Previous symbols' and 'Alias symbols') it is added to gene_aliases.
+path_gene_aliases = os.path.join(in_dir, 'hgnc_aliases.txt')
+gene_aliases = { # Alias or legacy symbol : canonical symbol (uppercase)
+    'CHOP'    : 'DDIT3',
+    'GADD153' : 'DDIT3',
+    'ATP5A1'  : 'ATP5F1A',
+    'ATP5B'   : 'ATP5F1B',
+    'ATP5C1'  : 'ATP5F1C',
+    'ATP5D'   : 'ATP5F1D',
+    'ATP5E'   : 'ATP5F1E',
+    'ATP5O'   : 'ATP5PO',
+    'CARS'    : 'CARS1',
+    'GRP78'   : 'HSPA5',
+    'BIP'     : 'HSPA5',
+    'CIP1'    : 'CDKN1A',
+    'WAF1'    : 'CDKN1A',
+    'HNRPC'   : 'HNRNPC',
+    'SFRS1'   : 'SRSF1',
+    'SFRS2'   : 'SRSF2',
+    'SFRS3'   : 'SRSF3',
+    }
+
 x_window = 1 # Clamps the x-axis of differential splicing (all values are between -1 and 1)
 min_pval = 0.00000000000000000001 # Used as a ceiling to limit the scale of the 2nd axis with miniscule p-values
 
@@ -66,7 +148,7 @@ min_pval = 0.00000000000000000001 # Used as a ceiling to limit the scale of the
 # Defining the structure of the PDF file
 # =============================================================================
 # Here, each key will be a page in a pdf with the values being a list of plots for that page (using the names for plots defined in of dict_df).
-# A first page with info on launch parameters is automatically generated and the last two are populated dynamically
+# A first page with info on launch parameters is automatically generated and the last pages are populated dynamically
 dict_pdf_layout = {
     # T-ALL vs thymus
     'T-ALL vs thymus - Differential Expression, Proteomics, and Splicing' : ['TALL_shortRead_deseq' ,'TALL_ONT_deseq', 'TALL_proteomics', 'TALL_rMATS'],
@@ -133,242 +215,605 @@ dict_pdf_layout = {
     # NMD-related (from some Table 5 somewhere)
     'E7107 and NMDi-associated gene expression changes (CUTLL1, 24h)' : [],
     # Proteomics from Northwestern
-    'Proteomics on E7107 treatment - Data from Northwestern' : []
+    'Proteomics on E7107 treatment - Data from Northwestern' : [],
+    # Correlation of effect sizes between all datasets (only if make_concordance_page)
+    'Concordance between datasets' : [],
+    # One forest plot per gene across all datasets (only if make_gene_cards)
+    'Gene cards' : []
     }
 
 #%%This dictionary will contain pandas dataframes of all the Interesting Lists
 #This cell takes a few minutes to run. If it has already been run and loaded into memory and no changes to the dataframe has been made - you could skip it.
+
+# =============================================================================
+# Local mirror of the network share
+# =============================================================================
+# Files are compared on size and modification time. A file that differs is copied (and hashed while copying), and only counts as changed if its
+# checksum differs from the last sync. The mirror keeps the modification times of the share, so the Arrow store only re-reads datasets whose files changed.
+def copy_and_hash(path_src, path_dst):
+    digest = hashlib.sha1()
+    os.makedirs(os.path.dirname(path_dst), exist_ok=True)
+    with open(path_src, 'rb') as f_src, open(path_dst + '.tmp', 'wb') as f_dst:
+        for block in iter(lambda: f_src.read(1024**2), b''):
+            digest.update(block)
+            f_dst.write(block)
+    shutil.copystat(path_src, path_dst + '.tmp')
+    os.replace(path_dst + '.tmp', path_dst)
+    return digest.hexdigest()
+
+def sync_mirror(src_dir=share_dir, dst_dir=mirror_dir):
+    '''Brings dst_dir up to date with src_dir and returns the (added, changed, removed) files, relative to src_dir'''
+    path_state = os.path.join(dst_dir, '.mirror_state.json')
+    state = {}
+    if os.path.exists(path_state):
+        with open(path_state) as f:
+            state = json.load(f)
+
+    added, changed, seen = [], [], set()
+    for root, dirs, files in os.walk(src_dir):
+        for file in files:
+            path_src = os.path.join(root, file)
+            rel = os.path.relpath(path_src, src_dir)
+            seen.add(rel)
+            stat = os.stat(path_src)
+            if rel in state and state[rel][:2] == [stat.st_size, stat.st_mtime] and os.path.exists(os.path.join(dst_dir, rel)):
+                continue
+            checksum = copy_and_hash(path_src, os.path.join(dst_dir, rel))
+            if rel not in state:
+                added.append(rel)
+            elif state[rel][2] != checksum:
+                changed.append(rel)
+            else: # Touched but identical: keep the old modification time so nothing is re-read
+                os.utime(os.path.join(dst_dir, rel), (stat.st_atime, state[rel][1]))
+            state[rel] = [stat.st_size, stat.st_mtime, checksum]
+
+    removed = [rel for rel in state if rel not in seen]
+    for rel in removed:
+        del state[rel]
+        if os.path.exists(os.path.join(dst_dir, rel)):
+            os.remove(os.path.join(dst_dir, rel))
+    os.makedirs(dst_dir, exist_ok=True)
+    with open(path_state, 'w') as f:
+        json.dump(state, f)
+    return added, changed, removed
+
+# A shard (see Sharded runs) leaves the mirror, watch mode and the clean-up of the Arrow store to the run that starts or merges the shards,
+# as shards running at the same time would otherwise race on them.
+shard = os.environ.get('IL_SHARD') # 'index/number of shards' if this process is a shard
+
+if globals().get('watch_thread') is not None: # Re-running this cell first stops the watcher started before (once its current sync is done)
+    stop_watching.set()
+    watch_thread.join()
+    watch_thread = None
+
+if use_local_mirror and shard is None:
+    print('\n -- Syncing %s to %s...' %(share_dir, mirror_dir))
+    added, changed, removed = sync_mirror()
+    print(' -- %i files added, %i changed, %i removed' %(len(added), len(changed), len(removed)))
+
+pval_cols = ['padj', 'fdr', 'pval', 'p.value', 'adj p val_t allvsthymus_'] # Columns (lowercase) that are cleaned of invalid p-values below
+
+def get_schema(df_key):
+    '''
+    Returns the columns the analysis reads from the dataframe named df_key as {role: column}.
+    Roles are 'gene', 'x' (effect size), 'p' (p-value/FDR), 'neglogp' (-log10 p-value) and 'event' (rMATS event type),
+    and 'chrom', 'start' and 'end' for the coordinates of splicing events and peaks (see regions_of_interest).
+    A tuple lists alternative columns, of which the first one present is used. The dispatch mirrors the analysis loop.
+    '''
+    if 'rMATS' in df_key:
+        # The columns holding the coordinates differ per event type. An event spans from the lowest start to the highest end present
+        return {'gene': 'geneSymbol', 'x': 'IncLevelDifference', 'p': 'FDR', 'event': 'Splicing Event', 'chrom': ('chr', 'chrom'),
+                'start': ('upstreamES', 'exonStart_0base', 'riExonStart_0base', '1stExonStart_0base', 'longExonStart_0base', 'flankingES'),
+                'end': ('downstreamEE', 'exonEnd', 'riExonEnd', '2ndExonEnd', 'longExonEnd', 'flankingEE')}
+    elif 'edgeR' in df_key:
+        return {'gene': 'geneSymbol', 'x': 'log2FC', 'p': 'padj'}
+    elif 'deseq' in df_key:
+        return {'gene': 'gene_symbol', 'x': 'log2FoldChange', 'p': 'padj'}
+    elif 'ATAC' in df_key:
+        return {'gene': 'Gene Name', 'x': 'log2FoldChange', 'p': 'padj', 'chrom': ('Chr', 'chr'), 'start': ('Start', 'start'), 'end': ('End', 'end')}
+    elif 'proteomics' in df_key:
+        if 'perseus' in df_key:
+            return {'gene': 'Genes', 'x': ('Difference', 'log2FC'), 'neglogp': '-Log(P-value)', 'p': 'neglogpval'}
+        elif 'TALL_proteomics' in df_key:
+            return {'gene': 'Gene names', 'x': 'log2FC', 'p': 'adj P Val_T ALLvsThymus_'}
+        elif 'RPB1_v_IgG_IP' in df_key:
+            return {'gene': 'Genes', 'x': 'log2FC', 'p': 'p-value'}
+        elif 'Freya' in df_key or 'Kevin' in df_key:
+            return {'gene': 'Genes', 'x': 'logFC', 'p': 'adj.P.Val'}
+        elif '_STM' in df_key:
+            return {'gene': 'Gene', 'x': 'log2FC', 'p': 'FDR'}
+        else:
+            return {'gene': 'GeneSymbol', 'x': 'log2FC', 'neglogp': 'neglogPVal'}
+    return {} # Unknown data type: all columns are read
+
+def read_interesting_list(df_key, file, sheet_name=0, sep=',', skiprows=None):
+    '''
+    Reads one Interesting List from in_dir, parsing only the columns get_schema(df_key) asks for (plus any p-value columns cleaned below) with explicit dtypes.
+    CSV/TSV files use the pyarrow engine if it is installed. Only the needed columns are ever held, so large files need no chunking.
+    If a numeric column turns out to hold text, the file is re-read without dtype hints and clean_pvals_in_dict deals with it as before.
+    '''
+    path = os.path.join(in_dir, file)
+    schema = get_schema(df_key)
+    dtypes = {}
+    for role, cols in schema.items():
+        for col in (cols if isinstance(cols, tuple) else (cols,)):
+            dtypes[col] = str if role in ('gene', 'event', 'chrom') else 'float64'
+
+    def keep(col):
+        return not schema or col in dtypes or str(col).lower() in pval_cols
+
+    if file.endswith(('.xlsx', '.xls')):
+        try:
+            return pd.read_excel(path, sheet_name=sheet_name, skiprows=skiprows, usecols=keep, dtype=dtypes)
+        except ValueError:
+            return pd.read_excel(path, sheet_name=sheet_name, skiprows=skiprows, usecols=keep)
+
+    header  = pd.read_csv(path, sep=sep, skiprows=skiprows, nrows=0).columns
+    usecols = [col for col in header if keep(col)]
+    dtypes  = {col: dtype for col, dtype in dtypes.items() if col in usecols}
+    engine  = 'pyarrow' if has_pyarrow else 'c'
+    try:
+        return pd.read_csv(path, sep=sep, skiprows=skiprows, usecols=usecols, dtype=dtypes, engine=engine)
+    except ValueError:
+        return pd.read_csv(path, sep=sep, skiprows=skiprows, usecols=usecols, engine=engine)
+
+# =============================================================================
+# Normalised gene symbols
+# =============================================================================
+def resolve_column(cols, columns):
+    '''Returns the first of cols (a column name or a tuple of alternatives) that is in columns, or None'''
+    for col in (cols if isinstance(cols, tuple) else (cols,)):
+        if col in columns:
+            return col
+    return None
+
+def read_gene_aliases(path):
+    '''Reads a genenames.org download into {previous or alias symbol: approved symbol}. Symbols that are approved for another gene are never remapped.'''
+    df_hgnc  = pd.read_csv(path, sep='\t', dtype=str)
+    approved = df_hgnc['Approved symbol'].str.upper()
+    pairs = []
+    for col in ['Previous symbols', 'Alias symbols']: # Previous symbols take precedence over aliases
+        others = df_hgnc[col].str.upper().str.split(',')
+        pairs.append(pd.DataFrame({'other': others, 'approved': approved}).explode('other').dropna())
+    pairs = pd.concat(pairs)
+    pairs['other'] = pairs['other'].str.strip()
+    pairs = pairs[(pairs['other'] != '') & ~pairs['other'].isin(set(approved))].drop_duplicates('other')
+    return dict(zip(pairs['other'], pairs['approved']))
+
+if os.path.exists(path_gene_aliases):
+    gene_aliases = {**read_gene_aliases(path_gene_aliases), **gene_aliases}
+gene_aliases_version = hashlib.sha1(json.dumps(sorted(gene_aliases.items())).encode()).hexdigest()[:12] # Stored datasets are re-keyed when the alias table changes
+
+def normalise_symbols(symbols):
+    '''Vectorised: strips and uppercases gene symbols (so human and mouse symbols match) and maps aliases to canonical symbols. Missing symbols stay missing.'''
+    symbols = pd.Series(symbols, dtype=object)
+    keys = symbols.where(symbols.isna(), symbols.astype(str).str.strip().str.upper()).replace('', np.nan)
+    return keys.map(gene_aliases).fillna(keys)
+
+def add_gene_keys(dict_df):
+    '''Adds the normalised symbol of each row as a 'gene_key' column. Done once, before datasets go into the Arrow store.'''
+    for df_key, df in dict_df.items():
+        gene_col = resolve_column(get_schema(df_key).get('gene'), df.columns)
+        df['gene_key'] = normalise_symbols(df[gene_col]) if gene_col is not None else np.nan
+    return dict_df
+
+# =============================================================================
+# Arrow dataset store
+# =============================================================================
+# Cleaned dataframes are written as uncompressed Arrow IPC files (one per distinct content digest) together with a manifest of the source file each was read from.
+# A dataset whose source is unchanged is memory-mapped from the store instead of being parsed again. Memory-mapped numeric columns are not copied,
+# so any number of processes opening the same dataset share one physical copy of it and start almost instantly.
+def source_signature(df_key):
+    source = dict_sources[df_key]
+    stat = os.stat(os.path.join(in_dir, source['file']))
+    schema = hashlib.sha1(json.dumps(get_schema(df_key), sort_keys=True).encode()).hexdigest()[:12] # Stored datasets are re-read when the columns they need change
+    return dict(source, size=stat.st_size, mtime=stat.st_mtime, gene_aliases=gene_aliases_version, schema=schema)
+
+file_digests = {} # (path, size, mtime) : hash of the bytes of the file. Sheets of one workbook (and datasets sharing a file) hash it only once
+
+def file_digest(path):
+    stat = os.stat(path)
+    if (path, stat.st_size, stat.st_mtime) not in file_digests:
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024**2), b''):
+                digest.update(block)
+        file_digests[(path, stat.st_size, stat.st_mtime)] = digest.hexdigest()
+    return file_digests[(path, stat.st_size, stat.st_mtime)]
+
+def content_digest(df_key):
+    '''Hash of the bytes of a dataset's source file together with how it is read (sheet, options, columns). Datasets with the same digest are identical.'''
+    source = dict_sources[df_key]
+    read_as = [{k: v for k, v in source.items() if k != 'file'}, get_schema(df_key), file_digest(os.path.join(in_dir, source['file']))]
+    return hashlib.sha1(json.dumps(read_as, sort_keys=True).encode()).hexdigest()
+
+def read_store_manifest():
+    path_manifest = os.path.join(store_dir, 'manifest.json')
+    if not os.path.exists(path_manifest):
+        return {}
+    with open(path_manifest) as f:
+        return json.load(f)
+
+def write_store_manifest(manifest):
+    for df_key, entry in read_store_manifest().items(): # Keeps the up-to-date datasets other processes (shards) added in the meantime
+        if df_key not in manifest and df_key in dict_sources and entry.get('source') == source_signature(df_key):
+            manifest[df_key] = entry
+    os.makedirs(store_dir, exist_ok=True)
+    path_tmp = os.path.join(store_dir, 'manifest.json.%i.tmp' %(os.getpid())) # Shards may write at the same time
+    with open(path_tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path_tmp, os.path.join(store_dir, 'manifest.json'))
+
+def write_dataset(digest, df):
+    import pyarrow as pa
+    os.makedirs(store_dir, exist_ok=True)
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError): # Columns mixing text and numbers are stored as text
+        df = df.copy()
+        for col in df.columns[df.dtypes == object]:
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    path_tmp = os.path.join(store_dir, '%s.arrow.%i.tmp' %(digest, os.getpid())) # Shards may write the same dataset at the same time
+    with pa.OSFile(path_tmp, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(path_tmp, os.path.join(store_dir, digest + '.arrow'))
+
+def cached_table(name, signature, compute, version=1):
+    '''
+    Returns a table computed from the datasets, recomputing it only if signature (anything JSON-serialisable describing the inputs) or version changed.
+    Bump version when the computation itself changes. Results are pickled in store_dir/results (also without use_arrow_store) and a copy is written to out_dir as <name>.tsv.
+    '''
+    path_table = os.path.join(store_dir, 'results', name + '.pkl')
+    path_signature = os.path.join(store_dir, 'results', name + '.json')
+    path_tsv = os.path.join(out_dir, name + '.tsv')
+    signature = json.loads(json.dumps({'version': version, 'inputs': signature}))
+    if os.path.exists(path_table) and os.path.exists(path_signature):
+        with open(path_signature) as f:
+            if json.load(f) == signature:
+                table = pd.read_pickle(path_table)
+                if not os.path.exists(path_tsv) or os.path.getmtime(path_tsv) < os.path.getmtime(path_table): # out_dir was emptied or changed
+                    table.to_csv(path_tsv, sep='\t')
+                return table
+    table = compute()
+    os.makedirs(os.path.dirname(path_table), exist_ok=True)
+    table.to_pickle(path_table)
+    with open(path_signature, 'w') as f:
+        json.dump(signature, f)
+    table.to_csv(path_tsv, sep='\t')
+    return table
+
+def open_dataset(df_key, manifest=None):
+    '''Memory-maps one dataset from the Arrow store. Safe to call from any process.'''
+    import pyarrow as pa
+    manifest = manifest or read_store_manifest()
+    with pa.memory_map(os.path.join(store_dir, manifest[df_key]['content'] + '.arrow'), 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(split_blocks=True) # split_blocks keeps numeric columns as views of the mapped file
+
+class DatasetPool(MutableMapping):
+    '''
+    Stands in for dict_df when pool_budget_mb is set: holds at most budget_mb of dataframes in memory.
+    Touching a dataframe that is not resident loads it (from the Arrow store), evicting the least recently used ones to stay within budget.
+    Duplicate dataframes (aliases) resolve to the one they are identical to, so they are held only once.
+    '''
+    def __init__(self, df_keys, budget_mb, load, aliases=None):
+        self.df_keys   = list(df_keys)
+        self.budget    = budget_mb * 1024**2
+        self.load      = load
+        self.aliases   = aliases if aliases is not None else {}
+        self.resident  = OrderedDict() # df_key : dataframe, least recently used first
+        self.sizes     = {}
+        self.lock      = threading.RLock() # Watch mode updates the pool from another thread
+        self.hits = self.misses = self.evictions = 0
+
+    def __getitem__(self, df_key):
+        if df_key not in self.df_keys:
+            raise KeyError(df_key)
+        df_key = self.aliases.get(df_key, df_key)
+        with self.lock:
+            if df_key in self.resident:
+                self.hits += 1
+                self.resident.move_to_end(df_key)
+                return self.resident[df_key]
+            self.misses += 1
+            df = self.load(df_key)
+            self._hold(df_key, df)
+            return df
+
+    def __setitem__(self, df_key, df):
+        with self.lock:
+            if df_key not in self.df_keys:
+                self.df_keys.append(df_key)
+            self._hold(self.aliases.get(df_key, df_key), df)
+
+    def __delitem__(self, df_key):
+        with self.lock:
+            self.df_keys.remove(df_key)
+            self.resident.pop(df_key, None)
+            self.sizes.pop(df_key, None)
+
+    def __iter__(self):
+        return iter(list(self.df_keys))
+
+    def __len__(self):
+        return len(self.df_keys)
+
+    def _hold(self, df_key, df):
+        self.resident[df_key] = df
+        self.resident.move_to_end(df_key)
+        self.sizes[df_key] = df.memory_usage(deep=True).sum()
+        while sum(self.sizes.values()) > self.budget and len(self.resident) > 1:
+            evicted, _ = self.resident.popitem(last=False)
+            del self.sizes[evicted]
+            self.evictions += 1
+
+    def release(self, df_key):
+        '''Drops a dataframe from memory (it stays in the pool and is loaded again when touched)'''
+        df_key = self.aliases.get(df_key, df_key)
+        with self.lock:
+            self.resident.pop(df_key, None)
+            self.sizes.pop(df_key, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'resident': len(self.resident), 'resident_mb': round(sum(self.sizes.values()) / 1024**2, 1)}
+
+# Each key names a dataframe and each value says where and how it is read (file in in_dir and, for Excel, sheet_name/skiprows, or the separator for text files)
 print('\n -- Reading in data...')
-dict_df = {
+dict_sources = {
     #Kevin proteomics
-    'Kevin_kinase_inhibitors_proteomics_GNF2133_6h'   : pd.read_excel(os.path.join(in_dir,   "Kevin_kinase_inhibitors_proteomics.xlsx"), sheet_name = 'GNF2133_6h'),
-    'Kevin_kinase_inhibitors_proteomics_GNF2133_24h'   : pd.read_excel(os.path.join(in_dir,   "Kevin_kinase_inhibitors_proteomics.xlsx"), sheet_name = 'GNF2133_24h'),
-    'Kevin_kinase_inhibitors_proteomics_THZ531_6h'   : pd.read_excel(os.path.join(in_dir,   "Kevin_kinase_inhibitors_proteomics.xlsx"), sheet_name = 'THZ531_6h'),
-    'Kevin_kinase_inhibitors_proteomics_THZ531_24h'   : pd.read_excel(os.path.join(in_dir,   "Kevin_kinase_inhibitors_proteomics.xlsx"), sheet_name = 'THZ531_24h'),
-    'Kevin_kinase_inhibitors_proteomics_E7107_6h'   : pd.read_excel(os.path.join(in_dir,   "Kevin_kinase_inhibitors_proteomics.xlsx"), sheet_name = 'E7107_6h'),
-    'Kevin_kinase_inhibitors_proteomics_E7107_24h'   : pd.read_excel(os.path.join(in_dir,   "Kevin_kinase_inhibitors_proteomics.xlsx"), sheet_name = 'E7107_24h'),
-    'Kevin_kinase_inhibitors_proteomics_CTX712_6h'   : pd.read_excel(os.path.join(in_dir,   "Kevin_kinase_inhibitors_proteomics.xlsx"), sheet_name = 'CTX712_6h'),
-    'Kevin_kinase_inhibitors_proteomics_CTX712_24h'   : pd.read_excel(os.path.join(in_dir,   "Kevin_kinase_inhibitors_proteomics.xlsx"), sheet_name = 'CTX712_24h'),
+    'Kevin_kinase_inhibitors_proteomics_GNF2133_6h'   : dict(file="Kevin_kinase_inhibitors_proteomics.xlsx", sheet_name = 'GNF2133_6h'),
+    'Kevin_kinase_inhibitors_proteomics_GNF2133_24h'   : dict(file="Kevin_kinase_inhibitors_proteomics.xlsx", sheet_name = 'GNF2133_24h'),
+    'Kevin_kinase_inhibitors_proteomics_THZ531_6h'   : dict(file="Kevin_kinase_inhibitors_proteomics.xlsx", sheet_name = 'THZ531_6h'),
+    'Kevin_kinase_inhibitors_proteomics_THZ531_24h'   : dict(file="Kevin_kinase_inhibitors_proteomics.xlsx", sheet_name = 'THZ531_24h'),
+    'Kevin_kinase_inhibitors_proteomics_E7107_6h'   : dict(file="Kevin_kinase_inhibitors_proteomics.xlsx", sheet_name = 'E7107_6h'),
+    'Kevin_kinase_inhibitors_proteomics_E7107_24h'   : dict(file="Kevin_kinase_inhibitors_proteomics.xlsx", sheet_name = 'E7107_24h'),
+    'Kevin_kinase_inhibitors_proteomics_CTX712_6h'   : dict(file="Kevin_kinase_inhibitors_proteomics.xlsx", sheet_name = 'CTX712_6h'),
+    'Kevin_kinase_inhibitors_proteomics_CTX712_24h'   : dict(file="Kevin_kinase_inhibitors_proteomics.xlsx", sheet_name = 'CTX712_24h'),
 
     #Jonas ETO
-    '2025_023_combo_v_DMSO_proteomics_STM'   : pd.read_csv(os.path.join(in_dir,   "Jonas_2025_023_combo_vs_DMSO.csv")),
-    # '2025_023_ETO_v_DMSO_proteomics_STM'     : pd.read_csv(os.path.join(in_dir,   "Jonas_2025_023_etoposide_vs_DMSO.csv"), sep=';'),
-    '2025_023_STM3006_v_DMSO_proteomics_STM' : pd.read_csv(os.path.join(in_dir,   "Jonas_2025_023_STM3006_vs_DMSO.csv")),
-    'ETO_vs_DMSO_deseq' : pd.read_csv(os.path.join(in_dir,   "DESeq2_results_ETO_vs_DMSO_annotated.csv")),
+    '2025_023_combo_v_DMSO_proteomics_STM'   : dict(file="Jonas_2025_023_combo_vs_DMSO.csv"),
+    # '2025_023_ETO_v_DMSO_proteomics_STM'     : dict(file="Jonas_2025_023_etoposide_vs_DMSO.csv", sep=';'),
+    '2025_023_STM3006_v_DMSO_proteomics_STM' : dict(file="Jonas_2025_023_STM3006_vs_DMSO.csv"),
+    'ETO_vs_DMSO_deseq' : dict(file="DESeq2_results_ETO_vs_DMSO_annotated.csv"),
 
     #NAMPT KO
-    'NAMPT_KO_deseq' : pd.read_excel(os.path.join(in_dir, 'Results_NAMPT_KO.xlsx'), sheet_name='Results'),
-    'NAMPT_KO_rMATS' : pd.read_csv(os.path.join(in_dir, 'NAMPTKO_1_scr_2NAMPTKO_rMATS_compiled.tsv'), sep='\t'),
+    'NAMPT_KO_deseq' : dict(file='Results_NAMPT_KO.xlsx', sheet_name='Results'),
+    'NAMPT_KO_rMATS' : dict(file='NAMPTKO_1_scr_2NAMPTKO_rMATS_compiled.tsv', sep='\t'),
 
     #Aifantis N-Me enhancer deletion in NOTCH1-driven T-ALL
-    'NMe_deletion_in_NOTCH1_TALL_deseq' : pd.read_csv(os.path.join(in_dir,   "NMe_deletion_in_NOTCH1_TALL_GSE57988.tsv"), sep='\t'),
-    'SIRT1_loss_in_NOTCH_TALL_deseq'    : pd.read_csv(os.path.join(in_dir,   "SIRT1_loss_in_NOTCH1_TALL_PMC9818047.csv")),
+    'NMe_deletion_in_NOTCH1_TALL_deseq' : dict(file="NMe_deletion_in_NOTCH1_TALL_GSE57988.tsv", sep='\t'),
+    'SIRT1_loss_in_NOTCH_TALL_deseq'    : dict(file="SIRT1_loss_in_NOTCH1_TALL_PMC9818047.csv"),
 
     # T-ALL vs. Thymus
-    'TALL_rMATS'                        : pd.read_csv(os.path.join(in_dir,   "thymus_v_TALL_rMATS_compiled.tsv"), sep='\t'),
-    'TALL_shortRead_deseq'              : pd.read_excel(os.path.join(in_dir, "Table S3. RNA seq Thymus vs TALL_article.xlsx"), sheet_name='Short-read analysis', skiprows=1),
-    'TALL_ONT_deseq'                    : pd.read_excel(os.path.join(in_dir, "Table S3. RNA seq Thymus vs TALL_article.xlsx"), sheet_name='ONT'),
-    'TALL_proteomics'                   : pd.read_excel(os.path.join(in_dir, "TALL-MS_results_shotgun proteomics Thymus vs. T-ALL PRC-6051_DIA June 2023.xlsx"), sheet_name='S3 DiffExpression testing'),
+    'TALL_rMATS'                        : dict(file="thymus_v_TALL_rMATS_compiled.tsv", sep='\t'),
+    'TALL_shortRead_deseq'              : dict(file="Table S3. RNA seq Thymus vs TALL_article.xlsx", sheet_name='Short-read analysis', skiprows=1),
+    'TALL_ONT_deseq'                    : dict(file="Table S3. RNA seq Thymus vs TALL_article.xlsx", sheet_name='ONT'),
+    'TALL_proteomics'                   : dict(file="TALL-MS_results_shotgun proteomics Thymus vs. T-ALL PRC-6051_DIA June 2023.xlsx", sheet_name='S3 DiffExpression testing'),
 
     # PRC2
-    # 'PRC2_ATAC_E7070'                   : pd.read_csv(os.path.join(in_dir,   "contrast_ATAC_E7070_v_ctrl.tsv"), sep='\t'),
-    # 'PRC2_ATAC_E7107'                   : pd.read_csv(os.path.join(in_dir,   "contrast_ATAC_E7107_v_ctrl.tsv"), sep='\t'),
-    # 'PRC2_ATAC_Taz'                     : pd.read_csv(os.path.join(in_dir,   "contrast_ATAC_Taz_v_ctrl.tsv"), sep='\t'),
-    'PRC2_ATAC_KO1'                     : pd.read_csv(os.path.join(in_dir,   "ATAC_KO1_annotation.csv")),
-    'PRC2_ATAC_KO2'                     : pd.read_csv(os.path.join(in_dir,   "ATAC_KO2_annotation.csv")),
-    'PRC2_ATAC_KO'                      : pd.read_csv(os.path.join(in_dir,   "ATAC_KO_annotation.csv")),
+    # 'PRC2_ATAC_E7070'                   : dict(file="contrast_ATAC_E7070_v_ctrl.tsv", sep='\t'),
+    # 'PRC2_ATAC_E7107'                   : dict(file="contrast_ATAC_E7107_v_ctrl.tsv", sep='\t'),
+    # 'PRC2_ATAC_Taz'                     : dict(file="contrast_ATAC_Taz_v_ctrl.tsv", sep='\t'),
+    'PRC2_ATAC_KO1'                     : dict(file="ATAC_KO1_annotation.csv"),
+    'PRC2_ATAC_KO2'                     : dict(file="ATAC_KO2_annotation.csv"),
+    'PRC2_ATAC_KO'                      : dict(file="ATAC_KO_annotation.csv"),
 
     # #PRC2 rMATS
-    'E7107_rMATS'                       : pd.read_excel(os.path.join(in_dir, 'PRC2_rMATS_results_PSI0.05_FDR0.1.xlsx'), sheet_name='E7107'),
-    'E7070_rMATS'                       : pd.read_excel(os.path.join(in_dir, 'PRC2_rMATS_results_PSI0.05_FDR0.1.xlsx'), sheet_name='Indisulam'),
-    'Tazemetostat_rMATS'                : pd.read_excel(os.path.join(in_dir, 'PRC2_rMATS_results_PSI0.05_FDR0.1.xlsx'), sheet_name='Tazemetostat'),
-    'KO1_rMATS'                         : pd.read_excel(os.path.join(in_dir, 'PRC2_rMATS_results_PSI0.05_FDR0.1.xlsx'), sheet_name='KO1'),
-    'KO2_rMATS'                         : pd.read_excel(os.path.join(in_dir, 'PRC2_rMATS_results_PSI0.05_FDR0.1.xlsx'), sheet_name='KO2'),
+    'E7107_rMATS'                       : dict(file='PRC2_rMATS_results_PSI0.05_FDR0.1.xlsx', sheet_name='E7107'),
+    'E7070_rMATS'                       : dict(file='PRC2_rMATS_results_PSI0.05_FDR0.1.xlsx', sheet_name='Indisulam'),
+    'Tazemetostat_rMATS'                : dict(file='PRC2_rMATS_results_PSI0.05_FDR0.1.xlsx', sheet_name='Tazemetostat'),
+    'KO1_rMATS'                         : dict(file='PRC2_rMATS_results_PSI0.05_FDR0.1.xlsx', sheet_name='KO1'),
+    'KO2_rMATS'                         : dict(file='PRC2_rMATS_results_PSI0.05_FDR0.1.xlsx', sheet_name='KO2'),
 
     # #PRC2 edgeR
-    'PRC2_edgeR_E7107'                  : pd.read_csv(os.path.join(in_dir,   'edgeR_results_E7107.tsv'), sep='\t'),
-    'PRC2_edgeR_Indisulam'              : pd.read_csv(os.path.join(in_dir,   'edgeR_results_Indisulam.tsv'), sep='\t'),
-    'PRC2_edgeR_Tazemetostat'           : pd.read_csv(os.path.join(in_dir,   'edgeR_results_Tazemetostat.tsv'), sep='\t'),
-    'PRC2_edgeR_KO1'                    : pd.read_csv(os.path.join(in_dir,   'edgeR_results_KO1.tsv'), sep='\t'),
-    'PRC2_edgeR_KO2'                    : pd.read_csv(os.path.join(in_dir,   'edgeR_results_KO2.tsv'), sep='\t'),
-    'EZH2ko_Mansour_2020_deseq'         : pd.read_csv(os.path.join(in_dir,   'EZH2ko_v_Jurkat_GSE127261.tsv'), sep='\t'),
+    'PRC2_edgeR_E7107'                  : dict(file='edgeR_results_E7107.tsv', sep='\t'),
+    'PRC2_edgeR_Indisulam'              : dict(file='edgeR_results_Indisulam.tsv', sep='\t'),
+    'PRC2_edgeR_Tazemetostat'           : dict(file='edgeR_results_Tazemetostat.tsv', sep='\t'),
+    'PRC2_edgeR_KO1'                    : dict(file='edgeR_results_KO1.tsv', sep='\t'),
+    'PRC2_edgeR_KO2'                    : dict(file='edgeR_results_KO2.tsv', sep='\t'),
+    'EZH2ko_Mansour_2020_deseq'         : dict(file='EZH2ko_v_Jurkat_GSE127261.tsv', sep='\t'),
 
     # #PRC2 proteomics
-    # 'E7070_v_DMSO_proteomics_perseus'   : pd.read_csv(os.path.join(in_dir,   "E7070vsDMSO.txt"), sep='\t'),
-    # 'E7107_v_DMSO_proteomics_perseus'   : pd.read_csv(os.path.join(in_dir,   "E7107vsDMSO.txt"), sep='\t'),
-    'Taz_v_DMSO_proteomics_perseus'     : pd.read_csv(os.path.join(in_dir,   "TazvsDMSO.txt"), sep='\t'),
-    'KO1_v_DMSO_proteomics_perseus'     : pd.read_csv(os.path.join(in_dir,   "KO1vsDMSO.txt"), sep='\t'),
-    'KO2_v_DMSO_proteomics_perseus'     : pd.read_csv(os.path.join(in_dir,   "KO2vsDMSO.txt"), sep='\t'),
+    # 'E7070_v_DMSO_proteomics_perseus'   : dict(file="E7070vsDMSO.txt", sep='\t'),
+    # 'E7107_v_DMSO_proteomics_perseus'   : dict(file="E7107vsDMSO.txt", sep='\t'),
+    'Taz_v_DMSO_proteomics_perseus'     : dict(file="TazvsDMSO.txt", sep='\t'),
+    'KO1_v_DMSO_proteomics_perseus'     : dict(file="KO1vsDMSO.txt", sep='\t'),
+    'KO2_v_DMSO_proteomics_perseus'     : dict(file="KO2vsDMSO.txt", sep='\t'),
 
     #Laura FK866 and NAMPT KD
-    'FK866_2.5_24h_deseq'               : pd.read_csv(os.path.join(in_dir,'FK25_24h_results.tsv'), sep='\t'),
-    'FK866_2.5_48h_deseq'               : pd.read_csv(os.path.join(in_dir,'FK25_48h_results.tsv'), sep='\t'),
-    'FK866_5.0_24h_deseq'               : pd.read_csv(os.path.join(in_dir,'FK5_24h_results.tsv'), sep='\t'),
-    'FK866_5.0_48h_deseq'               : pd.read_csv(os.path.join(in_dir,'FK5_48h_results.tsv'), sep='\t'),
-    'NAMPT_KD_deseq'                    : pd.read_csv(os.path.join(in_dir, 'RNAseq_NAMPT_KD.csv')),
+    'FK866_2.5_24h_deseq'               : dict(file='FK25_24h_results.tsv', sep='\t'),
+    'FK866_2.5_48h_deseq'               : dict(file='FK25_48h_results.tsv', sep='\t'),
+    'FK866_5.0_24h_deseq'               : dict(file='FK5_24h_results.tsv', sep='\t'),
+    'FK866_5.0_48h_deseq'               : dict(file='FK5_48h_results.tsv', sep='\t'),
+    'NAMPT_KD_deseq'                    : dict(file='RNAseq_NAMPT_KD.csv'),
 
-    # 'FK866_proteomics_perseus'          : pd.read_csv(os.path.join(in_dir, '20240827_Proteomics_FK866_norm-perseus-for-volcano.csv')),
+    # 'FK866_proteomics_perseus'          : dict(file='20240827_Proteomics_FK866_norm-perseus-for-volcano.csv'),
 
     # STM2457
-    'STM2457_TMT2_proteomics'           : pd.read_csv(os.path.join(in_dir,   'STM2457_TMT2_results_STM_R_DMSO_L.txt'), sep='\t'),
-    'STM2457_TMT3_proteomics'           : pd.read_csv(os.path.join(in_dir,   'STM2457_TMT3_results_STM_R_DMSO_L.txt'), sep='\t'),
+    'STM2457_TMT2_proteomics'           : dict(file='STM2457_TMT2_results_STM_R_DMSO_L.txt', sep='\t'),
+    'STM2457_TMT3_proteomics'           : dict(file='STM2457_TMT3_results_STM_R_DMSO_L.txt', sep='\t'),
 
     #GSK126 (EZH2 inhibitor) proteomics
-    'GSK126_v_DMSO_proteomics_perseus'  : pd.read_csv(os.path.join(in_dir,   "GSK126_R_vs_DMSO_L.txt"), sep='\t'),
+    'GSK126_v_DMSO_proteomics_perseus'  : dict(file="GSK126_R_vs_DMSO_L.txt", sep='\t'),
 
     # Jonas T-ALL&STM 3seq, m6a, expression, splicing
-    "TallSTM_path_rMATS"                : pd.read_excel(os.path.join(in_dir, "TALL&STM1.xlsx"), sheet_name='eclip_expression_splicing_data'),
-    "TallSTM_path_deseq"                : pd.read_excel(os.path.join(in_dir, "TALL&STM1.xlsx"), sheet_name='m6a_with_expression_dataset'),
+    "TallSTM_path_rMATS"                : dict(file="TALL&STM1.xlsx", sheet_name='eclip_expression_splicing_data'),
+    "TallSTM_path_deseq"                : dict(file="TALL&STM1.xlsx", sheet_name='m6a_with_expression_dataset'),
 
     #Igor proteomics on 24h incubation with E7107
-    # "E7107_24_proteomics"               : pd.read_csv(os.path.join(in_dir,   "24hE7107vsDMSO.csv")), # Only one of these has the correct direction - which one?
-    "E7107_24_proteomics"               : pd.read_csv(os.path.join(in_dir,   "DMSOvs24hE7107.csv")),
+    # "E7107_24_proteomics"               : dict(file="24hE7107vsDMSO.csv"), # Only one of these has the correct direction - which one?
+    "E7107_24_proteomics"               : dict(file="DMSOvs24hE7107.csv"),
 
     # High Risk versus Low Risk
-    'risk_edgeR'                        : pd.read_excel(os.path.join(in_dir, "HRvsLR1. Expression Low-Risk_VS_High-Risk.htseq.edgeR.xlsx"), sheet_name='Low-Risk_VS_High-Risk.htseq.edg'),
-    'risk_rMATS_kasper'                 : pd.read_csv(os.path.join(in_dir,   "rmats_combined_analysis.tsv"), sep='\t'),
+    'risk_edgeR'                        : dict(file="HRvsLR1. Expression Low-Risk_VS_High-Risk.htseq.edgeR.xlsx", sheet_name='Low-Risk_VS_High-Risk.htseq.edg'),
+    'risk_rMATS_kasper'                 : dict(file="rmats_combined_analysis.tsv", sep='\t'),
 
     #Han et al. transcription changes are dose-dependent on inhibition by E7107 
-    "E7107_TS2_24_splicing_rMATS"       : pd.read_excel(os.path.join(in_dir, "E7107-induced splicng changes sciadv.abj8357_table_s2.xlsx"), sheet_name="24h FDR<0.05 PSI>0.1", skiprows=1),
-    "SciAdv_TS4_E7107_edgeR_15min"      : pd.read_excel(os.path.join(in_dir, "SciAdv_TS4_E7107_DoseDependent_edgeR.xlsx"), sheet_name='DMSO_vs_E7107_15min.htseq.edgeR'), #Table S4. E7107-associated gene expression changes (CUTLL1, 15min)
-    "SciAdv_TS4_E7107_edgeR_1.5nm"      : pd.read_excel(os.path.join(in_dir, "SciAdv_TS4_E7107_DoseDependent_edgeR.xlsx"), sheet_name='DMSO_vs_E7107_1.5nm.htseq.edgeR'), #Table S4. E7107-associated splicing events changes in CUTLL1 cells (1.5nm)
-    "SciAdv_TS4_E7107_edgeR_3.0nm"      : pd.read_excel(os.path.join(in_dir, "SciAdv_TS4_E7107_DoseDependent_edgeR.xlsx"), sheet_name='DMSO_vs_E7107_3nm.htseq.edgeR'), #Table S4. E7107-associated gene expression changes in CUTLL1 cells (3nm)
+    "E7107_TS2_24_splicing_rMATS"       : dict(file="E7107-induced splicng changes sciadv.abj8357_table_s2.xlsx", sheet_name="24h FDR<0.05 PSI>0.1", skiprows=1),
+    "SciAdv_TS4_E7107_edgeR_15min"      : dict(file="SciAdv_TS4_E7107_DoseDependent_edgeR.xlsx", sheet_name='DMSO_vs_E7107_15min.htseq.edgeR'), #Table S4. E7107-associated gene expression changes (CUTLL1, 15min)
+    "SciAdv_TS4_E7107_edgeR_1.5nm"      : dict(file="SciAdv_TS4_E7107_DoseDependent_edgeR.xlsx", sheet_name='DMSO_vs_E7107_1.5nm.htseq.edgeR'), #Table S4. E7107-associated splicing events changes in CUTLL1 cells (1.5nm)
+    "SciAdv_TS4_E7107_edgeR_3.0nm"      : dict(file="SciAdv_TS4_E7107_DoseDependent_edgeR.xlsx", sheet_name='DMSO_vs_E7107_3nm.htseq.edgeR'), #Table S4. E7107-associated gene expression changes in CUTLL1 cells (3nm)
 
     #Han et al. Silencing SF3B1 leads to inhibition of DDR (DNA damage response)x
-    #"SciAdv_TS5_E7107_edgeR"	   : pd.read_excel(SciAdv_TS5_shSF3B1_edgeR, sheet_name='DMSO_vs_3nM_E7107.htseq.edgeR'), #Table S5. E7107 vs vehicle gene expression changes in CUTLL1 cells. Appears to be identical to "SciAdv_TS4_E7107_edgeR_3.0nm"
-    "SciAdv_TS5_shSF3B1_edgeR_1"        : pd.read_excel(os.path.join(in_dir, "SciAdv_TS5_shSF3B1_edgeR.xlsx"), sheet_name='shCtrl_vs_shSF3B1.1.htseq.edgeR'), #Table S5. shSF3B1.1-associated gene expression changes in CUTLL1 cells
-    "SciAdv_TS5_shSF3B1_edgeR_2"        : pd.read_excel(os.path.join(in_dir, "SciAdv_TS5_shSF3B1_edgeR.xlsx"), sheet_name='shCtrl_vs_shSF3B1.2.htseq.edgeR'), #Table S5. shSF3B1.2-associated gene expression changes in CUTLL1 cells
-    "CancDisc_shSRSF6_v_JURKAT_edgeR"   : pd.read_csv(os.path.join(in_dir,   'shSRSF6_v_JURKAT_Zhou_2020.csv')),
+    #"SciAdv_TS5_E7107_edgeR"	   : dict(file="SciAdv_TS5_shSF3B1_edgeR.xlsx", sheet_name='DMSO_vs_3nM_E7107.htseq.edgeR'), #Table S5. E7107 vs vehicle gene expression changes in CUTLL1 cells. Appears to be identical to "SciAdv_TS4_E7107_edgeR_3.0nm"
+    "SciAdv_TS5_shSF3B1_edgeR_1"        : dict(file="SciAdv_TS5_shSF3B1_edgeR.xlsx", sheet_name='shCtrl_vs_shSF3B1.1.htseq.edgeR'), #Table S5. shSF3B1.1-associated gene expression changes in CUTLL1 cells
+    "SciAdv_TS5_shSF3B1_edgeR_2"        : dict(file="SciAdv_TS5_shSF3B1_edgeR.xlsx", sheet_name='shCtrl_vs_shSF3B1.2.htseq.edgeR'), #Table S5. shSF3B1.2-associated gene expression changes in CUTLL1 cells
+    "CancDisc_shSRSF6_v_JURKAT_edgeR"   : dict(file='shSRSF6_v_JURKAT_Zhou_2020.csv'),
 
     #Han et al. Splicing alterations caused by SF3B1 silencing is similar to E7107 inhibition
-    "SciAdv_TS3_shSF3B1_rMATS_1"        : pd.read_excel(os.path.join(in_dir, "SciAdv_TS3_shSF3B1_rMATS.xlsx"), sheet_name='shSF3B1.1 VS control'), # Table S3. shSF3B1.1-associated splicing events changes in CUTLL1 cells
-    "SciAdv_TS3_shSF3B1_rMATS_2"        : pd.read_excel(os.path.join(in_dir, "SciAdv_TS3_shSF3B1_rMATS.xlsx"), sheet_name='shSF3B1.2 VS control'), #Table S3. shSF3B1.2-associated splicing events changes in CUTLL1 cells
+    "SciAdv_TS3_shSF3B1_rMATS_1"        : dict(file="SciAdv_TS3_shSF3B1_rMATS.xlsx", sheet_name='shSF3B1.1 VS control'), # Table S3. shSF3B1.1-associated splicing events changes in CUTLL1 cells
+    "SciAdv_TS3_shSF3B1_rMATS_2"        : dict(file="SciAdv_TS3_shSF3B1_rMATS.xlsx", sheet_name='shSF3B1.2 VS control'), #Table S3. shSF3B1.2-associated splicing events changes in CUTLL1 cells
 
     #Blood 2024
-    'CD19B_v_BALL_rMATS'                : pd.read_csv(os.path.join(in_dir,   'Blood_2024_CD19B_v_BALL.csv')),
-    # 'RPB1_v_IgG_IP_proteomics_perseus'  : pd.read_excel(os.path.join(in_dir, 'Blood_2024_RNApolII_IP_proteomics.xlsx'), sheet_name='IgG vs RPB1', skiprows=3),
+    'CD19B_v_BALL_rMATS'                : dict(file='Blood_2024_CD19B_v_BALL.csv'),
+    # 'RPB1_v_IgG_IP_proteomics_perseus'  : dict(file='Blood_2024_RNApolII_IP_proteomics.xlsx', sheet_name='IgG vs RPB1', skiprows=3),
 
     #SciAdv 2024, Demoen
-    '72h_post_PSIP1_KD_JURKAT_deseq'    : pd.read_csv(os.path.join(in_dir,   'ST6_significant_DGE_Jurkat_PSIP1_KD.csv')),
-    'Lisa_PTEN_deseq'                   : pd.read_csv(os.path.join(in_dir,   'ST2_significant_DGE_Pten.csv')),
-    'Lisa_LMO2_deseq'                   : pd.read_csv(os.path.join(in_dir,   'ST3_significant_DGE_Lmo2.csv')),
+    '72h_post_PSIP1_KD_JURKAT_deseq'    : dict(file='ST6_significant_DGE_Jurkat_PSIP1_KD.csv'),
+    'Lisa_PTEN_deseq'                   : dict(file='ST2_significant_DGE_Pten.csv'),
+    'Lisa_LMO2_deseq'                   : dict(file='ST3_significant_DGE_Lmo2.csv'),
 
     # ETP v TALL
-    'TALL_v_ETP_Rodriguez_deseq'         : pd.read_csv(os.path.join(in_dir, 'TALL_v_ETP_GSE243914.csv')),
-    'TALL_v_ETP_Kloetgen_deseq'          : pd.read_csv(os.path.join(in_dir, 'TALL_v_ETP_GSE115895.tsv'), sep='\t'),
-    'T_ALL_v_ETP_Zhang_2011_deseq'       : pd.read_csv(os.path.join(in_dir, 'TALL_v_ETP_GSE28703.tsv'), sep='\t'),
+    'TALL_v_ETP_Rodriguez_deseq'         : dict(file='TALL_v_ETP_GSE243914.csv'),
+    'TALL_v_ETP_Kloetgen_deseq'          : dict(file='TALL_v_ETP_GSE115895.tsv', sep='\t'),
+    'T_ALL_v_ETP_Zhang_2011_deseq'       : dict(file='TALL_v_ETP_GSE28703.tsv', sep='\t'),
 
     #TALL v others (public)
-    'TALL_v_T-cell_Cramer_2013_deseq'    : pd.read_csv(os.path.join(in_dir, 'TALL_v_Tcell_GSE48558.tsv'), sep='\t'),
-    'TALL_v_healthy_MILE_2009_deseq'     : pd.read_csv(os.path.join(in_dir, 'TALL_v_healthy_GSE13159.tsv'), sep='\t'),
-    'TALL_v_Thymus_Fernandes_2018_deseq' : pd.read_csv(os.path.join(in_dir, 'TALL_v_thymus_GSE109231.tsv'), sep='\t'),
+    'TALL_v_T-cell_Cramer_2013_deseq'    : dict(file='TALL_v_Tcell_GSE48558.tsv', sep='\t'),
+    'TALL_v_healthy_MILE_2009_deseq'     : dict(file='TALL_v_healthy_GSE13159.tsv', sep='\t'),
+    'TALL_v_Thymus_Fernandes_2018_deseq' : dict(file='TALL_v_thymus_GSE109231.tsv', sep='\t'),
 
     #HNRNPC KD in HCC
-    'HNRNPC_KD_v_MHCC97_deseq'           : pd.read_csv(os.path.join(in_dir, 'MHCC97_v_HNRNPC_KD_GSE180789.tsv'), sep='\t'),
+    'HNRNPC_KD_v_MHCC97_deseq'           : dict(file='MHCC97_v_HNRNPC_KD_GSE180789.tsv', sep='\t'),
 
     # shPSMG1
-    'shPSMG1_edgeR'                      : pd.read_csv(os.path.join(in_dir, 'shCtrl_vs_shPSMG1.htseq.edgeR.txt'), sep='\t'),
+    'shPSMG1_edgeR'                      : dict(file='shCtrl_vs_shPSMG1.htseq.edgeR.txt', sep='\t'),
 
     #CNS vs BM
-    'CNS_v_BM_Muench_2017_deseq'         : pd.read_csv(os.path.join(in_dir, 'CNS_v_BM_GSE89710.tsv'), sep='\t'),
-    'CNS_v_BM_BALL_Velden_2015_deseq'    : pd.read_csv(os.path.join(in_dir, 'CNS_v_BM_BALL_GSE60926.tsv'), sep='\t'),
+    'CNS_v_BM_Muench_2017_deseq'         : dict(file='CNS_v_BM_GSE89710.tsv', sep='\t'),
+    'CNS_v_BM_BALL_Velden_2015_deseq'    : dict(file='CNS_v_BM_BALL_GSE60926.tsv', sep='\t'),
     
-    'CNS_v_BM_Freya_rMATS'               : pd.read_csv(os.path.join(in_dir, '1_BM_2_CNS_rMATS_compiled.tsv'), sep='\t'),
-    'Freya_CNSvsBM_RNAseq_deseq'         : pd.read_csv(os.path.join(in_dir, 'Freya_CNSvsBM_RNAseq.csv')),
+    'CNS_v_BM_Freya_rMATS'               : dict(file='1_BM_2_CNS_rMATS_compiled.tsv', sep='\t'),
+    'Freya_CNSvsBM_RNAseq_deseq'         : dict(file='Freya_CNSvsBM_RNAseq.csv'),
     # - proteomics
 
     #Freya RNA-seq
-    'Freya_deseq_sh08_vs_NTC'       : pd.read_csv(os.path.join(in_dir, 'Freya_sh08_vs_NTC_annotated.csv')),
-    'Freya_deseq_time_48h_vs_24h'       : pd.read_csv(os.path.join(in_dir, 'Freya_time_48h_vs_24h_annotated.csv')),
-    'Freya_deseq_sh65_vs_NTC'       : pd.read_csv(os.path.join(in_dir, 'Freya_sh65_vs_NTC_annotated.csv')),
-    'Freya_deseq_time_72h_vs_24h'       : pd.read_csv(os.path.join(in_dir, 'Freya_time_72h_vs_24h_annotated.csv')),
-    'Freya_deseq_DL_vs_FCS_annotated'                         : pd.read_csv(os.path.join(in_dir, 'Freya_DL_vs_FCS_annotated.csv')),
-
-    'Freya_deseq_Interaction_MediumChange_sh08_vs_NTC'        : pd.read_csv(os.path.join(in_dir, 'Freya_Interaction_MediumChange_sh08_vs_NTC_annotated.csv')),
-    'Freya_deseq_Interaction_MediumChange_sh65_vs_NTC'        : pd.read_csv(os.path.join(in_dir, 'Freya_Interaction_MediumChange_sh65_vs_NTC_annotated.csv')),
-    'Freya_deseq_Interaction_TimeEffect_DL_vs_FCS_48h_vs_24h' : pd.read_csv(os.path.join(in_dir, 'Freya_Interaction_TimeEffect_DL_vs_FCS_48h_vs_24h_annotated.csv')),
-    'Freya_deseq_Interaction_TimeEffect_DL_vs_FCS_72h_vs_24h' : pd.read_csv(os.path.join(in_dir, 'Freya_Interaction_TimeEffect_DL_vs_FCS_72h_vs_24h_annotated.csv')),
-    'Freya_deseq_MediumChange_NTC_DL_vs_FCS'                  : pd.read_csv(os.path.join(in_dir, 'Freya_MediumChange_NTC_DL_vs_FCS_annotated.csv')),
-    'Freya_deseq_MediumChange_sh08_DL_vs_FCS'                 : pd.read_csv(os.path.join(in_dir, 'Freya_MediumChange_sh08_DL_vs_FCS_annotated.csv')),
-    'Freya_deseq_MediumChange_sh65_DL_vs_FCS'                 : pd.read_csv(os.path.join(in_dir, 'Freya_MediumChange_sh65_DL_vs_FCS_annotated.csv')),
-    'Freya_deseq_TimeEffect_DL_48h_vs_24h'                    : pd.read_csv(os.path.join(in_dir, 'Freya_TimeEffect_DL_48h_vs_24h_annotated.csv')),
-    'Freya_deseq_TimeEffect_DL_72h_vs_24h'                    : pd.read_csv(os.path.join(in_dir, 'Freya_TimeEffect_DL_72h_vs_24h_annotated.csv')),
-    'Freya_deseq_TimeEffect_FCS_48h_vs_24h'                   : pd.read_csv(os.path.join(in_dir, 'Freya_TimeEffect_FCS_48h_vs_24h_annotated.csv')),
-    'Freya_deseq_TimeEffect_FCS_72h_vs_24h'                   : pd.read_csv(os.path.join(in_dir, 'Freya_TimeEffect_FCS_72h_vs_24h_annotated.csv')),
+    'Freya_deseq_sh08_vs_NTC'       : dict(file='Freya_sh08_vs_NTC_annotated.csv'),
+    'Freya_deseq_time_48h_vs_24h'       : dict(file='Freya_time_48h_vs_24h_annotated.csv'),
+    'Freya_deseq_sh65_vs_NTC'       : dict(file='Freya_sh65_vs_NTC_annotated.csv'),
+    'Freya_deseq_time_72h_vs_24h'       : dict(file='Freya_time_72h_vs_24h_annotated.csv'),
+    'Freya_deseq_DL_vs_FCS_annotated'                         : dict(file='Freya_DL_vs_FCS_annotated.csv'),
+
+    'Freya_deseq_Interaction_MediumChange_sh08_vs_NTC'        : dict(file='Freya_Interaction_MediumChange_sh08_vs_NTC_annotated.csv'),
+    'Freya_deseq_Interaction_MediumChange_sh65_vs_NTC'        : dict(file='Freya_Interaction_MediumChange_sh65_vs_NTC_annotated.csv'),
+    'Freya_deseq_Interaction_TimeEffect_DL_vs_FCS_48h_vs_24h' : dict(file='Freya_Interaction_TimeEffect_DL_vs_FCS_48h_vs_24h_annotated.csv'),
+    'Freya_deseq_Interaction_TimeEffect_DL_vs_FCS_72h_vs_24h' : dict(file='Freya_Interaction_TimeEffect_DL_vs_FCS_72h_vs_24h_annotated.csv'),
+    'Freya_deseq_MediumChange_NTC_DL_vs_FCS'                  : dict(file='Freya_MediumChange_NTC_DL_vs_FCS_annotated.csv'),
+    'Freya_deseq_MediumChange_sh08_DL_vs_FCS'                 : dict(file='Freya_MediumChange_sh08_DL_vs_FCS_annotated.csv'),
+    'Freya_deseq_MediumChange_sh65_DL_vs_FCS'                 : dict(file='Freya_MediumChange_sh65_DL_vs_FCS_annotated.csv'),
+    'Freya_deseq_TimeEffect_DL_48h_vs_24h'                    : dict(file='Freya_TimeEffect_DL_48h_vs_24h_annotated.csv'),
+    'Freya_deseq_TimeEffect_DL_72h_vs_24h'                    : dict(file='Freya_TimeEffect_DL_72h_vs_24h_annotated.csv'),
+    'Freya_deseq_TimeEffect_FCS_48h_vs_24h'                   : dict(file='Freya_TimeEffect_FCS_48h_vs_24h_annotated.csv'),
+    'Freya_deseq_TimeEffect_FCS_72h_vs_24h'                   : dict(file='Freya_TimeEffect_FCS_72h_vs_24h_annotated.csv'),
 
     # # Freya proteomics
-    'Freya_proteomics_sh65_vs_NTC_DLD_48'         : pd.read_csv(os.path.join(in_dir, 'DE_sh65_vs_NTC_DLD_48.tsv'), sep='\t'),
-    'Freya_proteomics_sh65_vs_NTC_DLD_72'         : pd.read_csv(os.path.join(in_dir, 'DE_sh65_vs_NTC_DLD_72.tsv'), sep='\t'),
-    'Freya_proteomics_sh65_vs_NTC_FCS_48'         : pd.read_csv(os.path.join(in_dir, 'DE_sh65_vs_NTC_FCS_48.tsv'), sep='\t'),
-    'Freya_proteomics_sh65_vs_NTC_FCS_72'         : pd.read_csv(os.path.join(in_dir, 'DE_sh65_vs_NTC_FCS_72.tsv'), sep='\t'),
-    'Freya_proteomics_sh65_DLDvsFCS_effect_48'    : pd.read_csv(os.path.join(in_dir, 'DE_sh65_DLDvsFCS_effect_48.tsv'), sep='\t'),
-    'Freya_proteomics_sh65_DLDvsFCS_effect_72'    : pd.read_csv(os.path.join(in_dir, 'DE_sh65_DLDvsFCS_effect_72.tsv'), sep='\t'),
-    'Freya_proteomics_sh08_vs_NTC_DLD_48'         : pd.read_csv(os.path.join(in_dir, 'DE_sh08_vs_NTC_DLD_48.tsv'), sep='\t'),
-    'Freya_proteomics_sh08_vs_NTC_DLD_72'         : pd.read_csv(os.path.join(in_dir, 'DE_sh08_vs_NTC_DLD_72.tsv'), sep='\t'),
-    'Freya_proteomics_sh08_vs_NTC_FCS_48'         : pd.read_csv(os.path.join(in_dir, 'DE_sh08_vs_NTC_FCS_48.tsv'), sep='\t'),
-    'Freya_proteomics_sh08_vs_NTC_FCS_72'         : pd.read_csv(os.path.join(in_dir, 'DE_sh08_vs_NTC_FCS_72.tsv'), sep='\t'),
-    'Freya_proteomics_sh08_DLDvsFCS_effect_48'    : pd.read_csv(os.path.join(in_dir, 'DE_sh08_DLDvsFCS_effect_48.tsv'), sep='\t'),
-    'Freya_proteomics_sh08_DLDvsFCS_effect_72'    : pd.read_csv(os.path.join(in_dir, 'DE_sh08_DLDvsFCS_effect_72.tsv'), sep='\t'),
-    'Freya_proteomics_DLD_vs_FCS_NTC_48'          : pd.read_csv(os.path.join(in_dir, 'DE_DLD_vs_FCS_NTC_48.tsv'), sep='\t'),
-    'Freya_proteomics_DLD_vs_FCS_NTC_72'          : pd.read_csv(os.path.join(in_dir, 'DE_DLD_vs_FCS_NTC_72.tsv'), sep='\t'),
-    'Freya_proteomics_h72_vs_h48_NTC_DLD'         : pd.read_csv(os.path.join(in_dir, 'DE_h72_vs_h48_NTC_DLD.tsv'), sep='\t'),
-    'Freya_proteomics_h72_vs_h48_NTC_FCS'         : pd.read_csv(os.path.join(in_dir, 'DE_h72_vs_h48_NTC_FCS.tsv'), sep='\t'),
-    'Freya_proteomics_KDavg_DLDvsFCS_effect_48'   : pd.read_csv(os.path.join(in_dir, 'DE_KDavg_DLDvsFCS_effect_48.tsv'), sep='\t'),
-    'Freya_proteomics_KDavg_DLDvsFCS_effect_72'   : pd.read_csv(os.path.join(in_dir, 'DE_KDavg_DLDvsFCS_effect_72.tsv'), sep='\t'),
-    'Freya_proteomics_KDavg_DLDvsFCS_effect_alltimes'         : pd.read_csv(os.path.join(in_dir, 'DE_KDavg_DLDvsFCS_effect_alltimes.tsv'), sep='\t'),
-    'Freya_proteomics_KDavg_vs_NTC'               : pd.read_csv(os.path.join(in_dir, 'DE_KDavg_vs_NTC.tsv'), sep='\t'),
+    'Freya_proteomics_sh65_vs_NTC_DLD_48'         : dict(file='DE_sh65_vs_NTC_DLD_48.tsv', sep='\t'),
+    'Freya_proteomics_sh65_vs_NTC_DLD_72'         : dict(file='DE_sh65_vs_NTC_DLD_72.tsv', sep='\t'),
+    'Freya_proteomics_sh65_vs_NTC_FCS_48'         : dict(file='DE_sh65_vs_NTC_FCS_48.tsv', sep='\t'),
+    'Freya_proteomics_sh65_vs_NTC_FCS_72'         : dict(file='DE_sh65_vs_NTC_FCS_72.tsv', sep='\t'),
+    'Freya_proteomics_sh65_DLDvsFCS_effect_48'    : dict(file='DE_sh65_DLDvsFCS_effect_48.tsv', sep='\t'),
+    'Freya_proteomics_sh65_DLDvsFCS_effect_72'    : dict(file='DE_sh65_DLDvsFCS_effect_72.tsv', sep='\t'),
+    'Freya_proteomics_sh08_vs_NTC_DLD_48'         : dict(file='DE_sh08_vs_NTC_DLD_48.tsv', sep='\t'),
+    'Freya_proteomics_sh08_vs_NTC_DLD_72'         : dict(file='DE_sh08_vs_NTC_DLD_72.tsv', sep='\t'),
+    'Freya_proteomics_sh08_vs_NTC_FCS_48'         : dict(file='DE_sh08_vs_NTC_FCS_48.tsv', sep='\t'),
+    'Freya_proteomics_sh08_vs_NTC_FCS_72'         : dict(file='DE_sh08_vs_NTC_FCS_72.tsv', sep='\t'),
+    'Freya_proteomics_sh08_DLDvsFCS_effect_48'    : dict(file='DE_sh08_DLDvsFCS_effect_48.tsv', sep='\t'),
+    'Freya_proteomics_sh08_DLDvsFCS_effect_72'    : dict(file='DE_sh08_DLDvsFCS_effect_72.tsv', sep='\t'),
+    'Freya_proteomics_DLD_vs_FCS_NTC_48'          : dict(file='DE_DLD_vs_FCS_NTC_48.tsv', sep='\t'),
+    'Freya_proteomics_DLD_vs_FCS_NTC_72'          : dict(file='DE_DLD_vs_FCS_NTC_72.tsv', sep='\t'),
+    'Freya_proteomics_h72_vs_h48_NTC_DLD'         : dict(file='DE_h72_vs_h48_NTC_DLD.tsv', sep='\t'),
+    'Freya_proteomics_h72_vs_h48_NTC_FCS'         : dict(file='DE_h72_vs_h48_NTC_FCS.tsv', sep='\t'),
+    'Freya_proteomics_KDavg_DLDvsFCS_effect_48'   : dict(file='DE_KDavg_DLDvsFCS_effect_48.tsv', sep='\t'),
+    'Freya_proteomics_KDavg_DLDvsFCS_effect_72'   : dict(file='DE_KDavg_DLDvsFCS_effect_72.tsv', sep='\t'),
+    'Freya_proteomics_KDavg_DLDvsFCS_effect_alltimes'         : dict(file='DE_KDavg_DLDvsFCS_effect_alltimes.tsv', sep='\t'),
+    'Freya_proteomics_KDavg_vs_NTC'               : dict(file='DE_KDavg_vs_NTC.tsv', sep='\t'),
 
     #Laura ONT
-    'Laura_deseq_Jurkat_AG270_vs_DMSO'                 : pd.read_csv(os.path.join(in_dir, 'Laura_results_Jurkat_AG270_vs_DMSO_annotated.csv')),
-    'Laura_deseq_DND41_AG270_vs_DMSO'                  : pd.read_csv(os.path.join(in_dir, 'Laura_results_DND41_AG270_vs_DMSO_annotated.csv')),
-    'Laura_deseq_interaction_Jurkat_minus_DND41_AG270' : pd.read_csv(os.path.join(in_dir, 'Laura_results_interaction_Jurkat_minus_DND41_AG270_annotated.csv')),
+    'Laura_deseq_Jurkat_AG270_vs_DMSO'                 : dict(file='Laura_results_Jurkat_AG270_vs_DMSO_annotated.csv'),
+    'Laura_deseq_DND41_AG270_vs_DMSO'                  : dict(file='Laura_results_DND41_AG270_vs_DMSO_annotated.csv'),
+    'Laura_deseq_interaction_Jurkat_minus_DND41_AG270' : dict(file='Laura_results_interaction_Jurkat_minus_DND41_AG270_annotated.csv'),
 
     # Tim SOX
-    'Tim_SOX_deseq'                               : pd.read_excel(os.path.join(in_dir, 'Tim_SOX_deseq.xlsx'), sheet_name='Raw_data'),
+    'Tim_SOX_deseq'                               : dict(file='Tim_SOX_deseq.xlsx', sheet_name='Raw_data'),
 
     
-    'shCTCF_v_control_GSE130140_deseq'            : pd.read_csv(os.path.join(in_dir, 'shCTCF_v_control_GSE130140.tsv'), sep='\t'),
+    'shCTCF_v_control_GSE130140_deseq'            : dict(file='shCTCF_v_control_GSE130140.tsv', sep='\t'),
 
     #Fang
-    'shCTCF_v_control_deseq'         : pd.read_csv(os.path.join(in_dir, 'shCTCF_v_control_GSE130140.tsv'), sep='\t'),
-    'JURKAT_v_Tcell_deseq'           : pd.read_csv(os.path.join(in_dir, 'JURKAT_v_Tcell_GSE130140.tsv'), sep='\t'),
-    'GSI3d_v_JURKAT_deseq'           : pd.read_csv(os.path.join(in_dir, 'GSI3d_v_JURKAT_GSE130140.tsv'), sep='\t'),
-    'GSI3d_w6h_v_CUTTL1_deseq'       : pd.read_csv(os.path.join(in_dir, 'GSI3d_w6h_v_CUTTL1_GSE130140.tsv'), sep='\t'),
-    'GSI3d_v_CUTTL1_deseq'           : pd.read_csv(os.path.join(in_dir, 'GSI3d_v_CUTTL1_GSE130140.tsv'), sep='\t'),
-    'GSI3d_w4h_v_JURKAT_deseq'       : pd.read_csv(os.path.join(in_dir, 'GSI3d_w4h_v_JURKAT_GSE130140.tsv'), sep='\t'),
+    'shCTCF_v_control_deseq'         : dict(file='shCTCF_v_control_GSE130140.tsv', sep='\t'),
+    'JURKAT_v_Tcell_deseq'           : dict(file='JURKAT_v_Tcell_GSE130140.tsv', sep='\t'),
+    'GSI3d_v_JURKAT_deseq'           : dict(file='GSI3d_v_JURKAT_GSE130140.tsv', sep='\t'),
+    'GSI3d_w6h_v_CUTTL1_deseq'       : dict(file='GSI3d_w6h_v_CUTTL1_GSE130140.tsv', sep='\t'),
+    'GSI3d_v_CUTTL1_deseq'           : dict(file='GSI3d_v_CUTTL1_GSE130140.tsv', sep='\t'),
+    'GSI3d_w4h_v_JURKAT_deseq'       : dict(file='GSI3d_w4h_v_JURKAT_GSE130140.tsv', sep='\t'),
 
     #Marinaccio 2021
-    'MPLW515LSTK11KOvsMPLW515L_deseq'       : pd.read_excel(os.path.join(in_dir, 'Marinaccio_CancDisc_2021.xlsx'), sheet_name='MPLW515LSTK11KOvsMPLW515L_DEG'),
-    'MPLW515LSTK11KOvsWT_deseq'             : pd.read_excel(os.path.join(in_dir, 'Marinaccio_CancDisc_2021.xlsx'), sheet_name='MPLW515LSTK11KOvsWT_DEG'),
-    'MPLW515LvsWT_deseq'                    : pd.read_excel(os.path.join(in_dir, 'Marinaccio_CancDisc_2021.xlsx'), sheet_name='MPLW515LvsWT_DEG'),
+    'MPLW515LSTK11KOvsMPLW515L_deseq'       : dict(file='Marinaccio_CancDisc_2021.xlsx', sheet_name='MPLW515LSTK11KOvsMPLW515L_DEG'),
+    'MPLW515LSTK11KOvsWT_deseq'             : dict(file='Marinaccio_CancDisc_2021.xlsx', sheet_name='MPLW515LSTK11KOvsWT_DEG'),
+    'MPLW515LvsWT_deseq'                    : dict(file='Marinaccio_CancDisc_2021.xlsx', sheet_name='MPLW515LvsWT_DEG'),
 
     # Jin 2022, Science Advances, Chromatin accessibility in T-ALL cells upon USP7 inhibitor with or without dexamethasone
-    'Dasatinib_v_CUTTL1_deseq'                    : pd.read_csv(os.path.join(in_dir, 'Dasatinib_v_CUTTL1_GSE182680.tsv'), sep='\t'),
-    'shUSP11_v_CUTTL1_deseq'                      : pd.read_csv(os.path.join(in_dir, 'shUSP11_v_CUTTL1_GSE182680.tsv'), sep='\t'),
-    'shUSP11Dex_v_Dex_CUTTL1_deseq'               : pd.read_csv(os.path.join(in_dir, 'shUSP11Dex_v_Dex_CUTTL_GSE182680.tsv'), sep='\t'),
-    'Dex48hr_v_DND41_deseq'                       : pd.read_csv(os.path.join(in_dir, 'Dex48hr_v_DND41_GSE182680.tsv'), sep='\t'),
-    'Dex72hr_v_DND41_deseq'                           : pd.read_csv(os.path.join(in_dir, 'Dex_v_DND41_GSE182680.tsv'), sep='\t'),
-    'DexUSP7i_v_USP7i_72h_DND41_deseq'            : pd.read_csv(os.path.join(in_dir, 'DexUSP7i_v_USP7i_72h_DND41_GSE182680.tsv'), sep='\t'),
-    'DexUSP7i_v_USP7i_48h_DND41_deseq'            : pd.read_csv(os.path.join(in_dir, 'DexUSP7i_v_USP7i_48h_DND41_GSE182680.tsv'), sep='\t'),
+    'Dasatinib_v_CUTTL1_deseq'                    : dict(file='Dasatinib_v_CUTTL1_GSE182680.tsv', sep='\t'),
+    'shUSP11_v_CUTTL1_deseq'                      : dict(file='shUSP11_v_CUTTL1_GSE182680.tsv', sep='\t'),
+    'shUSP11Dex_v_Dex_CUTTL1_deseq'               : dict(file='shUSP11Dex_v_Dex_CUTTL_GSE182680.tsv', sep='\t'),
+    'Dex48hr_v_DND41_deseq'                       : dict(file='Dex48hr_v_DND41_GSE182680.tsv', sep='\t'),
+    'Dex72hr_v_DND41_deseq'                           : dict(file='Dex_v_DND41_GSE182680.tsv', sep='\t'),
+    'DexUSP7i_v_USP7i_72h_DND41_deseq'            : dict(file='DexUSP7i_v_USP7i_72h_DND41_GSE182680.tsv', sep='\t'),
+    'DexUSP7i_v_USP7i_48h_DND41_deseq'            : dict(file='DexUSP7i_v_USP7i_48h_DND41_GSE182680.tsv', sep='\t'),
 
     # #Kevin RNA-seq
-    'Kevin_CTX712_24_vs_DMSO_24_deseq'   : pd.read_csv(os.path.join(in_dir, 'Kevin_CTX-712_24_vs_DMSO_24_Results.csv')),
-    'Kevin_CTX712_6_vs_DMSO_6_deseq'      : pd.read_csv(os.path.join(in_dir, 'Kevin_CTX712_6_vs_DMSO_6_Results.csv')),
-    'Kevin_E7107_6_vs_DMSO_6_deseq'       : pd.read_csv(os.path.join(in_dir, 'Kevin_E7107_6_vs_DMSO_6_Results.csv')),
-    'Kevin_E7107_24_vs_DMSO_24_deseq'     : pd.read_csv(os.path.join(in_dir, 'Kevin_E7107_24_vs_DMSO_24_Results.csv')),
-    'Kevin_GNF2133_6_vs_DMSO_6_deseq'     : pd.read_csv(os.path.join(in_dir, 'Kevin_GNF2133_6_vs_DMSO_6_Results.csv')),
-    'Kevin_GNF2133_24_vs_DMSO_24_deseq'   : pd.read_csv(os.path.join(in_dir, 'Kevin_GNF2133_24_vs_DMSO_24_Results.csv')),
-    'Kevin_THZ531_6_vs_DMSO_6_deseq'      : pd.read_csv(os.path.join(in_dir, 'Kevin_THZ531_6_vs_DMSO_6_Results.csv')),
-    'Kevin_THZ531_24_vs_DMSO_24_deseq'    : pd.read_csv(os.path.join(in_dir, 'Kevin_THZ531_24_vs_DMSO_24_Results.csv')),
+    'Kevin_CTX712_24_vs_DMSO_24_deseq'   : dict(file='Kevin_CTX-712_24_vs_DMSO_24_Results.csv'),
+    'Kevin_CTX712_6_vs_DMSO_6_deseq'      : dict(file='Kevin_CTX712_6_vs_DMSO_6_Results.csv'),
+    'Kevin_E7107_6_vs_DMSO_6_deseq'       : dict(file='Kevin_E7107_6_vs_DMSO_6_Results.csv'),
+    'Kevin_E7107_24_vs_DMSO_24_deseq'     : dict(file='Kevin_E7107_24_vs_DMSO_24_Results.csv'),
+    'Kevin_GNF2133_6_vs_DMSO_6_deseq'     : dict(file='Kevin_GNF2133_6_vs_DMSO_6_Results.csv'),
+    'Kevin_GNF2133_24_vs_DMSO_24_deseq'   : dict(file='Kevin_GNF2133_24_vs_DMSO_24_Results.csv'),
+    'Kevin_THZ531_6_vs_DMSO_6_deseq'      : dict(file='Kevin_THZ531_6_vs_DMSO_6_Results.csv'),
+    'Kevin_THZ531_24_vs_DMSO_24_deseq'    : dict(file='Kevin_THZ531_24_vs_DMSO_24_Results.csv'),
 
     #Kevin_proteomics
     #HNRNPC KD (ours)
-    'HNRNPC_KD_v_3d_deseq'                        : pd.read_excel(os.path.join(in_dir, 'HNRNPC_KDvsCTR_3d.xlsx'),sheet_name='No_NA_KTC'),
-    'HNRNPC_KD_v_7d_deseq'                        : pd.read_excel(os.path.join(in_dir, 'HNRNPC_KDvsCTR_7d.xlsx'),sheet_name='No_NA_KTC'),
+    'HNRNPC_KD_v_3d_deseq'                        : dict(file='HNRNPC_KDvsCTR_3d.xlsx',sheet_name='No_NA_KTC'),
+    'HNRNPC_KD_v_7d_deseq'                        : dict(file='HNRNPC_KDvsCTR_7d.xlsx',sheet_name='No_NA_KTC'),
     }
 
+# Only datasets missing from the Arrow store (or whose source file changed) are parsed.
+# Datasets read from identical content (same bytes, sheet and options) are parsed once and share one dataframe: the duplicates are listed in dict_aliases and are not scanned again.
+stored  = read_store_manifest() if use_arrow_store else {}
+fresh   = {df_key for df_key in dict_sources if stored.get(df_key, {}).get('source') == source_signature(df_key)}
+digests = {df_key: stored[df_key]['content'] if df_key in fresh else content_digest(df_key) for df_key in dict_sources}
+
+dict_aliases = {} # Key of a duplicate dataframe : key of the dataframe it is identical to (preferably one that is on a page of the pdf)
+in_layout  = {df_key for plot_names in dict_pdf_layout.values() for df_key in plot_names}
+first_keys = {}
+for df_key in sorted(dict_sources, key=lambda df_key: df_key not in in_layout):
+    first_keys.setdefault(digests[df_key], df_key)
+    if first_keys[digests[df_key]] != df_key:
+        dict_aliases[df_key] = first_keys[digests[df_key]]
+        print(' -- %s is identical to %s: read once' %(df_key, dict_aliases[df_key]))
+
+# With pipeline_stages, nothing is parsed here: the pipeline reads each dataframe when it gets to it (see load_dataset).
+# Neither is it with pool_budget_mb (each dataframe is parsed, stored and memory-mapped when the pool first needs it, so no more than the budget is ever held)
+# nor in a shard (see Sharded runs), which then only reads the dataframes it scans.
+load_lazily = pipeline_stages or shard is not None or (use_arrow_store and pool_budget_mb is not None)
+dict_df = {df_key: read_interesting_list(df_key, **source) for df_key, source in dict_sources.items() if df_key not in fresh and df_key not in dict_aliases and not load_lazily}
+
 df_E7107_NW_MS                          = pd.read_excel(os.path.join(in_dir,  "PN 031821_tc-786_Marinaccio_C_humanTMT16_Northwestern.xlsx"), sheet_name="tc-786_proteinquant", skiprows=4, header=1)
 df_E7107_rescue                         = pd.read_excel(os.path.join(in_dir,  "NMD-related-Table 5. E7107 and NMDi-associated gene exprression changes (CUTLL1, 24h).xlsx"), sheet_name="E7107_vs_E7107-NMDi.htseq.edgeR", skiprows=1)
+df_E7107_NW_MS['gene_key']              = normalise_symbols(df_E7107_NW_MS["Protein Description"].str.extract(r"GN=(\S+)")[0])
+df_E7107_rescue['gene_key']             = normalise_symbols(df_E7107_rescue["gene"])
 
 # df_E7107_rescue                         = pd.read_excel('/Users/kachrist/Desktop/NMD-related-Table 5. E7107 and NMDi-associated gene exprression changes (CUTLL1, 24h).xlsx', sheet_name="E7107_vs_E7107-NMDi.htseq.edgeR", skiprows=1)
 
@@ -407,8 +852,6 @@ import numpy as np
 import pandas as pd
 
 def clean_pvals_in_dict(dict_df, min_pval=1e-10):
-    pval_cols = ['padj', 'fdr', 'pval', 'p.value', 'adj p val_t allvsthymus_']
-
     for key, df in dict_df.items():
         cols = [c for c in df.columns if c.lower() in pval_cols]
         if not cols:
@@ -433,9 +876,97 @@ def clean_pvals_in_dict(dict_df, min_pval=1e-10):
 
 
 dict_df = clean_pvals_in_dict(dict_df)
+dict_df = add_gene_keys(dict_df)
+
+store_lock = threading.Lock()
+dataset_lock = threading.Lock() # Held while dict_df is scanned or refreshed (watch mode refreshes it from another thread)
+def load_dataset(df_key):
+    '''Loads one dataframe when the pool first needs it: memory-mapped if it is in the Arrow store, otherwise read from in_dir, cleaned and added to the store'''
+    if use_arrow_store and df_key in manifest:
+        return open_dataset(df_key, manifest)
+    df = add_gene_keys(clean_pvals_in_dict({df_key: read_interesting_list(df_key, **dict_sources[df_key])}))[df_key]
+    if not use_arrow_store:
+        return df
+    write_dataset(digests[df_key], df)
+    with store_lock:
+        for key in dict_sources: # The dataframe and its duplicates
+            if dict_aliases.get(key, key) == df_key:
+                manifest[key] = {'source': source_signature(key), 'content': digests[key]}
+        write_store_manifest(manifest)
+    return open_dataset(df_key, manifest)
+
+if use_arrow_store:
+    for df_key, df in dict_df.items():
+        write_dataset(digests[df_key], df)
+    # Only dataframes that are in the store are listed (with pipeline_stages, the others are added as they are read)
+    manifest = {df_key: {'source': source_signature(df_key), 'content': digests[df_key]} for df_key in dict_sources if dict_aliases.get(df_key, df_key) in fresh | set(dict_df)}
+    write_store_manifest(manifest)
+    if shard is None: # Drop datasets that are no longer referenced
+        for file in os.listdir(store_dir):
+            if file.endswith(('.arrow', '.regions.npz')) and file.split('.')[0] not in digests.values():
+                os.remove(os.path.join(store_dir, file))
+    print(' -- %i dataframes parsed, %i memory-mapped from %s' %(len(dict_df), len([df_key for df_key in fresh if df_key not in dict_aliases]), store_dir)
+          + (' (the others are read when first needed)' if load_lazily else ''))
+if load_lazily:
+    dict_df = DatasetPool(dict_sources, pool_budget_mb if pool_budget_mb is not None else float('inf'), load_dataset, dict_aliases) # Datasets are loaded when first touched
+elif use_arrow_store:
+    dict_df = {df_key: open_dataset(df_key, manifest) for df_key in dict_sources if df_key not in dict_aliases} # Freshly parsed frames are swapped for their memory-mapped copies too
+if not isinstance(dict_df, DatasetPool):
+    dict_df = {df_key: dict_df[dict_aliases.get(df_key, df_key)] for df_key in dict_sources}
 
 print(' -- Data frames cleaned')
 
+def refresh_datasets(files):
+    '''Re-reads the datasets read from any of files (relative to in_dir), and their duplicates, updating dict_df, dict_aliases and the Arrow store'''
+    df_keys = {df_key for df_key in dict_sources if dict_sources[df_key]['file'] in files}
+    df_keys |= {alias for alias, df_key in dict_aliases.items() if df_key in df_keys} # Duplicates of a changed dataset may no longer be duplicates
+    if not df_keys:
+        return []
+    for df_key in df_keys:
+        digests[df_key] = content_digest(df_key)
+        dict_aliases.pop(df_key, None)
+    first_keys = {digests[df_key]: df_key for df_key in dict_sources if df_key not in df_keys and df_key not in dict_aliases}
+    dict_new = {}
+    for df_key in sorted(df_keys, key=list(dict_sources).index):
+        if digests[df_key] in first_keys:
+            dict_aliases[df_key] = first_keys[digests[df_key]]
+        else:
+            first_keys[digests[df_key]] = df_key
+            dict_new[df_key] = read_interesting_list(df_key, **dict_sources[df_key])
+    dict_new = add_gene_keys(clean_pvals_in_dict(dict_new))
+    if use_arrow_store:
+        for df_key, df in dict_new.items():
+            write_dataset(digests[df_key], df)
+        with store_lock: # The manifest load_dataset reads is updated in place, so dataframes the pool evicts are reloaded from the new files
+            for df_key in df_keys:
+                manifest[df_key] = {'source': source_signature(df_key), 'content': digests[df_key]}
+            write_store_manifest(manifest)
+        dict_new = {df_key: open_dataset(df_key, manifest) for df_key in dict_new}
+    dict_df.update(dict_new)
+    for df_key in df_keys - set(dict_new):
+        dict_df[df_key] = dict_df[dict_aliases[df_key]]
+    return sorted(df_keys)
+
+def watch_share(stop):
+    '''Background loop of watch mode: syncs the mirror every watch_interval seconds and re-reads datasets whose files changed'''
+    while not stop.wait(watch_interval):
+        try:
+            added, changed, removed = sync_mirror()
+            with dataset_lock: # Waits for a running scan to finish
+                refreshed = refresh_datasets(set(added + changed))
+            for rel in removed:
+                print(' -- [watch] %s was removed from %s' %(rel, share_dir))
+            if refreshed:
+                print(' -- [watch] re-read %s. Re-run the analysis cell to update the plots' %(', '.join(refreshed)))
+        except Exception as e: # A failed sync (e.g. the share is offline) is retried next time
+            print(' -- [watch] sync failed: %s' %(e))
+
+if use_local_mirror and watch_mirror and shard is None:
+    stop_watching = threading.Event() # stop_watching.set() ends watch mode
+    watch_thread  = threading.Thread(target=watch_share, args=(stop_watching,), daemon=True)
+    watch_thread.start()
+    print(' -- Watching %s for changes every %i seconds' %(share_dir, watch_interval))
+
 
 #%% ===========================================================================
 # ANALYSIS - Run this cell to execute script
@@ -447,19 +978,106 @@ print(' -- Data frames cleaned')
 # You can either:
 #    1) Define a list of genes yourself, e.g:
 #         genes_of_interest = ['MYC', 'TAL1', 'RBM39']
-#    2) Use KTC_GetGeneSet to find a set of genes. It will try - in order - to:
+#    2) Use get_gene_set to find a set of genes. It works offline and will try - in order - to:
 #        a) Check if the input is a list. If so, it will interpret it as a set of genes. e.g:
-#            genes_of_interest = KTC_GetGeneSet(['MYC', 'TAL1', 'RBM39'])
+#            genes_of_interest = get_gene_set(['MYC', 'TAL1', 'RBM39'])
 #        b) Locate a predefined set of genes by a name in the dictionary gene_sets in KTC_functions.py, e.g:
-#            genes_of_interest = KTC_GetGeneSet('Laura')
-#        c) Search Msigdb for a set of genes with that name. Default database is human (2024.1.Hs)), e.g:
-#            i)   genes_of_interest = KTC_GetGeneSet('HALLMARK_MYC_TARGETS_V1') # Find names here: https://www.gsea-msigdb.org/gsea/msigdb/index.jsp
-#            ii)  genes_of_interest = KTC_GetGeneSet('HALLMARK_MYC_TARGETS_V1', db_version='2024.1.Hs') # Funtionally identical to the above
-#            iii) genes_of_interest = KTC_GetGeneSet('HALLMARK_MYC_TARGETS_V1', db_version='2024.1.Mm') # Searching the mouse equivalent
-#        d) If all of the above fail, it defaults to interpret the string inout as a single gene, e.g:
-#            genes_of_interest = KTC_GetGeneSet('MYC')
+#            genes_of_interest = get_gene_set('Laura')
+#        c) Look up a set of genes with that name in the local MSigDB releases in msigdb_dir. Default database is human (2024.1.Hs)), e.g:
+#            i)   genes_of_interest = get_gene_set('HALLMARK_MYC_TARGETS_V1') # Find names here: https://www.gsea-msigdb.org/gsea/msigdb/index.jsp
+#            ii)  genes_of_interest = get_gene_set('HALLMARK_MYC_TARGETS_V1', db_version='2024.1.Hs') # Funtionally identical to the above
+#            iii) genes_of_interest = get_gene_set('HALLMARK_MYC_TARGETS_V1', db_version='2024.1.Mm') # Searching the mouse equivalent
+#            search_gene_sets('HALLMARK_MYC') lists the names of all sets starting with a prefix
+#        d) Use KTC_GetGeneSet for anything not found locally (this may go online). Sets resolved this way are cached for their db_version.
+#        e) If all of the above fail, it defaults to interpret the string inout as a single gene, e.g:
+#            genes_of_interest = get_gene_set('MYC')
+#    3) Add patterns, which are replaced by all matching genes found in the dataframes (see expand_gene_patterns), e.g:
+#         genes_of_interest = ['MYC', 'SRSF*', 'HNRNP*', 'ATP5?1*', 're:^SF3B[0-9]$']
+#       * matches any number of characters and ? one character. Entries starting with re: are regular expressions (case-insensitive).
+#       The genes each pattern was expanded to are listed on the first page of the pdf.
 # The genes will be reformatted in-script (capitalized or capitalizing only the first letter for proteins and genes, respectively)
 
+msigdb_dir = os.path.join(in_dir, 'msigdb') # Local MSigDB releases: .gmt or .json downloads with the version in their name (e.g. msigdb.v2024.1.Hs.json, h.all.v2024.1.Hs.symbols.gmt)
+
+def read_gmt(path):
+    '''Reads a .gmt file into {gene set name: [genes]}'''
+    gene_sets = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) > 2:
+                gene_sets[fields[0]] = [gene for gene in fields[2:] if gene]
+    return gene_sets
+
+def read_msigdb(db_version):
+    '''
+    Returns {gene set name: [genes]} for all MSigDB files of db_version in msigdb_dir.
+    The parsed sets are persisted in the Arrow store directory and only re-read when the files change.
+    '''
+    files = sorted(file for file in os.listdir(msigdb_dir) if '.v%s.' %(db_version) in file and file.endswith(('.gmt', '.json'))) if os.path.isdir(msigdb_dir) else []
+    signature = [[file, os.path.getsize(os.path.join(msigdb_dir, file)), os.path.getmtime(os.path.join(msigdb_dir, file))] for file in files]
+    path_index = os.path.join(store_dir, 'gene_sets', 'msigdb_%s.json' %(db_version))
+    if os.path.exists(path_index):
+        with open(path_index) as f:
+            index = json.load(f)
+        if index['files'] == signature:
+            return index['gene_sets']
+
+    gene_sets = {}
+    for file in files:
+        if file.endswith('.gmt'):
+            gene_sets.update(read_gmt(os.path.join(msigdb_dir, file)))
+        else:
+            with open(os.path.join(msigdb_dir, file)) as f:
+                gene_sets.update({name: entry['geneSymbols'] for name, entry in json.load(f).items()})
+    os.makedirs(os.path.dirname(path_index), exist_ok=True)
+    with open(path_index, 'w') as f:
+        json.dump({'files': signature, 'gene_sets': gene_sets}, f)
+    return gene_sets
+
+dict_msigdb = {} # db_version : (gene sets, sorted names for prefix search). Filled on first use
+
+def get_msigdb(db_version):
+    if db_version not in dict_msigdb:
+        gene_sets = read_msigdb(db_version)
+        dict_msigdb[db_version] = (gene_sets, sorted(gene_sets))
+    return dict_msigdb[db_version]
+
+def search_gene_sets(prefix, db_version='2024.1.Hs'):
+    '''Names of all gene sets of db_version starting with prefix (case-insensitive)'''
+    names = get_msigdb(db_version)[1]
+    prefix = prefix.upper()
+    return names[bisect.bisect_left(names, prefix):bisect.bisect_left(names, prefix + '\uffff')]
+
+def get_gene_set(query, db_version='2024.1.Hs'):
+    '''Resolves query to a list of genes without going online if possible (see the comments above)'''
+    if isinstance(query, list):
+        return query
+    try:
+        from KTC_functions import gene_sets as predefined_gene_sets
+    except ImportError:
+        predefined_gene_sets = {}
+    if query in predefined_gene_sets:
+        return list(predefined_gene_sets[query])
+    gene_sets = get_msigdb(db_version)[0]
+    if query.upper() in gene_sets:
+        return list(gene_sets[query.upper()])
+
+    path_resolved = os.path.join(store_dir, 'gene_sets', 'resolved_%s.json' %(db_version))
+    resolved = {}
+    if os.path.exists(path_resolved):
+        with open(path_resolved) as f:
+            resolved = json.load(f)
+    if query not in resolved:
+        genes = list(KTC_GetGeneSet(query, db_version=db_version))
+        if genes == [query]: # KTC_GetGeneSet fell back to a single gene: nothing worth caching
+            return genes
+        resolved[query] = genes
+        os.makedirs(os.path.dirname(path_resolved), exist_ok=True)
+        with open(path_resolved, 'w') as f:
+            json.dump(resolved, f)
+    return resolved[query]
+
 # . o O - - - CHANGE LIST OF GENES HERE - - - O o .
 genes_of_interest = ['ATF4', 'DDIT3', 'CHOP', 'ATF3', 'ASNS', 'CARS', 'PSAT1', 'CDKN1A', 'SESN1', 'SESN2', 'SRSF1', 'SRSF2', 'SRSF3', 'HNRNPC', 'DDX5', 'MYC', 'SF3B1', 'HSPA5', 'HERPUD1']
 genes_of_interest = ['ATP5C1']
@@ -467,6 +1085,66 @@ genes_of_interest = ['ATP5C1']
 # genes_of_interest = ['ATP6AP2']
 # print(genes_of_interest[:-1])
 # 
+# Genomic regions can be searched as well: splicing events (rMATS) and peaks (ATAC) that overlap them are highlighted like genes of interest,
+# and all overlapping events and peaks are saved to out_dir as regions_of_interest_hits.tsv (significant or not).
+# Regions are written like in a genome browser (1-based, inclusive), e.g. 'chr12:6,530,000-6,560,000', or are paths to BED files (relative to in_dir or absolute)
+regions_of_interest = []
+
+# =============================================================================
+# Gene patterns
+# =============================================================================
+# All gene_keys found in the dataframes are kept as one sorted list. A pattern with a fixed start (SRSF*, ATP5?1*) only needs the slice of the list
+# with that start, found with two binary searches, so it expands without going through the dataframes. Regular expressions are matched against the whole list.
+# The gene_keys of every dataframe are cached in the Arrow store directory by content digest, so only new or changed dataframes are read for the list.
+
+def gene_symbol_index():
+    '''Sorted list of all gene_keys in the dataframes'''
+    path_index = os.path.join(store_dir, 'gene_symbols.json')
+    cached = {}
+    if os.path.exists(path_index):
+        with open(path_index) as f:
+            cached = json.load(f)
+    symbols = {}
+    for df_key in dict_sources:
+        digest = digests[dict_aliases.get(df_key, df_key)] + gene_aliases_version
+        if digest not in symbols:
+            symbols[digest] = cached[digest] if digest in cached else sorted(dict_df[df_key]['gene_key'].dropna().unique().tolist())
+    if symbols.keys() != cached.keys():
+        os.makedirs(store_dir, exist_ok=True)
+        with open(path_index, 'w') as f:
+            json.dump(symbols, f)
+    return sorted(set().union(*symbols.values()))
+
+def is_gene_pattern(gene):
+    return str(gene).startswith('re:') or any(char in str(gene) for char in '*?')
+
+def expand_gene_patterns(genes, symbols):
+    '''Replaces the patterns in genes by the matching symbols (sorted). Returns the expanded list and {pattern: matching symbols}.'''
+    import fnmatch
+    expanded, expansions = [], {}
+    for gene in genes:
+        if not is_gene_pattern(gene):
+            expanded.append(gene)
+            continue
+        if gene.startswith('re:'):
+            regex = re.compile(gene[len('re:'):], re.IGNORECASE)
+            matches = [symbol for symbol in symbols if regex.search(symbol)]
+        else:
+            pattern = gene.upper()
+            prefix = re.split(r'[*?\[]', pattern)[0]
+            candidates = symbols[bisect.bisect_left(symbols, prefix):bisect.bisect_left(symbols, prefix + '\uffff')]
+            matches = [symbol for symbol in candidates if fnmatch.fnmatchcase(symbol, pattern)]
+        expansions[gene] = matches
+        expanded += matches
+    return list(dict.fromkeys(expanded)), expansions
+
+gene_pattern_expansions = {}
+if any(is_gene_pattern(gene) for gene in genes_of_interest):
+    with dataset_lock:
+        symbols = gene_symbol_index()
+    genes_of_interest, gene_pattern_expansions = expand_gene_patterns(genes_of_interest, symbols)
+    for pattern, matches in gene_pattern_expansions.items():
+        print('%s -> %i genes' %(pattern, len(matches)))
 
 plot_path_list = [] # Will contain paths to all figures generated for pdf generation. Populated automatically.
 
@@ -524,7 +1202,7 @@ def Volcano(dict_volcano, name, analType):
     # If this is differential splicing
     elif analType == "DE_splicing":
         if i_Xs and i_Ys:  # Only scatter significant points
-            plt.scatter(i_Xs, i_Ys, c=[AS_colors[type_] for type_ in AS_list], s=dp_size)
+            plt.scatter(i_Xs, i_Ys, c=[AS_colors[type_] for type_ in dict_volcano['AS_list']], s=dp_size)
         plt.axhline(-math.log10(thresh_pval), color='black', alpha=0.5)
         plt.axvline(thresh_PSI, color='black', alpha=0.5)
         plt.axvline(-thresh_PSI, color='black', alpha=0.5)
@@ -534,7 +1212,7 @@ def Volcano(dict_volcano, name, analType):
         plt.xticks([-1, -0.5, 0, 0.5, 1])
         plt.grid(alpha=0.2)
         if plot_legend:
-            legend_entries = [(type_, plt.Line2D([0], [0], marker='o', color='w', markerfacecolor=AS_colors[type_], markersize=8)) for type_ in set(AS_list)]
+            legend_entries = [(type_, plt.Line2D([0], [0], marker='o', color='w', markerfacecolor=AS_colors[type_], markersize=8)) for type_ in set(dict_volcano['AS_list'])]
             plt.legend([entry[1] for entry in legend_entries], [entry[0] for entry in legend_entries], fontsize=6*scale_factor, markerscale=2, loc='upper left')
 
     # If this is proteomics
@@ -576,21 +1254,221 @@ def Volcano(dict_volcano, name, analType):
 #This dictionary contains genenames as keys with a numbers as values for how many times it has appeared across different dataframes (max once per dataframe)
 #Thus if a gene clears the thresholds in seven dataframes it will have a value of seven (useful for ranking genes that seem relevant across different experiments)
 #This is only to try and find genes that appear frequently across many dataframes with significant events. It is not vital to produce graphs for individual genes.
+#Genes are counted by their normalised symbol (gene_key), so a gene called e.g. ATP5C1 in one table and ATP5F1C in another is counted as one gene.
 appearances = {}
-def add_appearance(geneName, alreadyAdded):
-	if geneName not in alreadyAdded:
-		if geneName in appearances:
-			alreadyAdded.append(geneName)
-			appearances[geneName] += 1
-		else:
-			appearances[geneName] = 1
 
-def pval_Clamper(_float):
-	if _float < min_pval:
-		return min_pval
-	else:
-		return _float
+def get_analType(df_key):
+    if 'rMATS' in df_key:
+        return 'DE_splicing'
+    elif 'edgeR' in df_key or 'deseq' in df_key or 'ATAC' in df_key:
+        return 'DE_expression'
+    elif 'proteomics' in df_key:
+        return 'DE_proteomics'
+    return None
+
+def tidy_dataset(df_key, df):
+    '''
+    Returns the columns of a dataframe the volcano plots are made from, under the same names for every type of data:
+        gene_key : normalised gene symbol (see normalise_symbols)
+        label    : gene symbol as shown on plots
+        x        : effect size (log2FC, or dPSI for splicing)
+        p        : p-value/FDR used for significance
+        event    : splicing event type (rMATS only)
+        chrom, start, end : coordinates of the event or peak (only if the dataframe has them)
+    '''
+    schema = get_schema(df_key)
+    gene   = df[resolve_column(schema['gene'], df.columns)]
+    x      = df[resolve_column(schema['x'], df.columns)]
+    if 'neglogp' in schema and resolve_column(schema['neglogp'], df.columns) is not None:
+        p = 10**(-df[resolve_column(schema['neglogp'], df.columns)])
+    else:
+        p = df[resolve_column(schema['p'], df.columns)]
+    tidy = pd.DataFrame({'gene_key': df['gene_key'], 'label': gene, 'x': pd.to_numeric(x, errors='coerce'), 'p': pd.to_numeric(p, errors='coerce')})
+
+    if get_analType(df_key) == 'DE_splicing':
+        tidy['event'] = df[schema['event']]
+        tidy['x'] = tidy['x'].where(tidy['event'] == 'SE', -tidy['x']) # There is discussion whether skipped exon events need to be flipped
+        tidy = tidy[tidy['x'].notna() & tidy['p'].notna() & tidy['event'].notna()]
+    if resolve_column(schema.get('chrom', ()), df.columns) is not None:
+        tidy['chrom'] = df[resolve_column(schema['chrom'], df.columns)]
+        tidy['start'] = df[[col for col in schema['start'] if col in df.columns]].apply(pd.to_numeric, errors='coerce').min(axis=1)
+        tidy['end']   = df[[col for col in schema['end'] if col in df.columns]].apply(pd.to_numeric, errors='coerce').max(axis=1)
+    if get_analType(df_key) != 'DE_proteomics':
+        tidy['label'] = tidy['label'].astype(str).str.upper()
+    return tidy
+
+def is_significant(tidy, analType):
+    if analType == 'DE_splicing':
+        return (tidy['p'] < thresh_FDR) & (tidy['x'].abs() >= thresh_PSI)
+    return (tidy['p'] < thresh_pval) & (tidy['x'].abs() >= thresh_l2FC)
+
+def summarise_genes(tidy):
+    '''One row per gene_key (the event with the lowest p-value), so that each gene has a single signed effect per dataset'''
+    tidy = tidy.dropna(subset=['gene_key', 'x', 'p'])
+    return tidy.sort_values('p', kind='stable').drop_duplicates('gene_key').set_index('gene_key')[['label', 'x', 'p']]
 
+# =============================================================================
+# Genomic regions
+# =============================================================================
+# The events or peaks of a dataframe are indexed by chromosome as start positions in sorted order, together with the longest interval on that chromosome.
+# Everything overlapping a region starts before the region ends and less than that longest interval before the region starts,
+# so two binary searches (np.searchsorted) narrow it down to a short slice, which is then checked against the ends.
+
+def normalise_chrom(chrom):
+    '''chr12, Chr12 and 12 are the same chromosome'''
+    chrom = pd.Series(chrom, dtype=object).astype(str).str.upper()
+    return chrom.str.replace(r'^CHR', '', regex=True).to_numpy()
+
+def parse_regions(regions):
+    '''Returns regions_of_interest as a dataframe of chrom, start, end (0-based, half-open) and name'''
+    rows = []
+    for region in regions:
+        match = re.fullmatch(r'\s*([^:\s]+):([\d,]+)-([\d,]+)\s*', str(region))
+        if match:
+            start, end = int(match.group(2).replace(',', '')), int(match.group(3).replace(',', ''))
+            rows.append((match.group(1), start - 1, end, region))
+            continue
+        path = region if os.path.isabs(region) else os.path.join(in_dir, region)
+        if not os.path.exists(path):
+            raise ValueError('%s is neither a region (e.g. chr12:6,530,000-6,560,000) nor a BED file' %(region))
+        with open(path) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if line.startswith(('#', 'track', 'browser')) or len(fields) < 3:
+                    continue
+                name = fields[3] if len(fields) > 3 else '%s:%s-%s' %(fields[0], fields[1], fields[2])
+                rows.append((fields[0], int(fields[1]), int(fields[2]), name))
+    df_regions = pd.DataFrame(rows, columns=['chrom', 'start', 'end', 'name'])
+    df_regions['chrom_key'] = normalise_chrom(df_regions['chrom'])
+    return df_regions
+
+class RegionIndex:
+    '''Sorted-start index over the intervals [start, end) of one dataframe. Queries return row positions.'''
+    def __init__(self, chrom, start, end):
+        start = np.asarray(start, dtype=float)
+        end   = np.asarray(end, dtype=float)
+        chrom = normalise_chrom(chrom)
+        valid = ~(np.isnan(start) | np.isnan(end)) & pd.notna(pd.Series(chrom)).to_numpy()
+        self.chroms = {}
+        for chrom_key, rows in pd.Series(np.flatnonzero(valid)).groupby(chrom[valid]):
+            rows = rows.to_numpy()
+            rows = rows[np.argsort(start[rows], kind='stable')]
+            self.chroms[chrom_key] = (start[rows], end[rows], rows, (end[rows] - start[rows]).max())
+
+    def query(self, chrom_key, starts, ends):
+        '''Row positions overlapping each of the regions (same chromosome) given by starts and ends, as one array per region'''
+        if chrom_key not in self.chroms:
+            return [np.array([], dtype=int) for _ in starts]
+        sorted_starts, sorted_ends, rows, max_length = self.chroms[chrom_key]
+        lo = np.searchsorted(sorted_starts, np.asarray(starts) - max_length, side='right')
+        hi = np.searchsorted(sorted_starts, np.asarray(ends), side='left')
+        return [rows[i:j][sorted_ends[i:j] > s] for i, j, s in zip(lo, hi, starts)]
+
+    def save(self, path):
+        arrays = {'chroms': np.array(list(self.chroms), dtype=str), 'max_lengths': np.array([entry[3] for entry in self.chroms.values()], dtype=float)}
+        for i, (sorted_starts, sorted_ends, rows, _) in enumerate(self.chroms.values()):
+            arrays['starts_%i' %(i)], arrays['ends_%i' %(i)], arrays['rows_%i' %(i)] = sorted_starts, sorted_ends, rows
+        path_tmp = '%s.%i.tmp' %(path, os.getpid())
+        with open(path_tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(path_tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        index = cls.__new__(cls)
+        with np.load(path) as arrays:
+            index.chroms = {str(chrom_key): (arrays['starts_%i' %(i)], arrays['ends_%i' %(i)], arrays['rows_%i' %(i)], arrays['max_lengths'][i])
+                            for i, chrom_key in enumerate(arrays['chroms'])}
+        return index
+
+# The index of a dataframe only depends on its content, so it is built once per content digest: kept in memory and, with the Arrow store,
+# saved next to the dataset as <digest>.regions.npz, so later runs (and shards) load it instead of building it again.
+dict_region_index = {} # Content digest : RegionIndex
+
+def get_region_index(df_key, tidy):
+    digest = digests[dict_aliases.get(df_key, df_key)]
+    if digest not in dict_region_index:
+        path_index = os.path.join(store_dir, digest + '.regions.npz')
+        if use_arrow_store and os.path.exists(path_index):
+            dict_region_index[digest] = RegionIndex.load(path_index)
+        else:
+            dict_region_index[digest] = RegionIndex(tidy['chrom'], tidy['start'], tidy['end'])
+            if use_arrow_store:
+                os.makedirs(store_dir, exist_ok=True)
+                dict_region_index[digest].save(path_index)
+    return dict_region_index[digest]
+
+def region_hits(tidy, df_regions, index):
+    '''Returns the rows of tidy that overlap any of df_regions (with the name of the region they overlap) and their positions in tidy'''
+    rows, names = [], []
+    for chrom_key, df_chrom in df_regions.groupby('chrom_key', sort=False):
+        for name, hit_rows in zip(df_chrom['name'], index.query(chrom_key, df_chrom['start'].to_numpy(), df_chrom['end'].to_numpy())):
+            rows.append(hit_rows)
+            names += [name]*len(hit_rows)
+    rows = np.concatenate(rows) if rows else np.array([], dtype=int)
+    return tidy.iloc[rows].assign(region=names), rows
+
+def scan_dataset(df_key, tidy, query_keys, region_rows=()):
+    '''
+    Splits one tidied dataframe into significant events for genes of interest (i_) and everything else (ni_), ready for Volcano.
+    Genes of interest are matched with one vectorised lookup of gene_key in query_keys. Rows at the positions in region_rows count as genes of interest too.
+    Also returns the normalised symbols of all significant events (for appearances) and their labels (for unbiased mode).
+    '''
+    analType = get_analType(df_key)
+    sig      = is_significant(tidy, analType)
+    interest = tidy['gene_key'].isin(query_keys).to_numpy(copy=True)
+    interest[np.asarray(region_rows, dtype=int)] = True
+    interest = sig & interest
+    Y        = -np.log10(tidy['p'].clip(lower=min_pval))
+    ni_X     = -tidy['x'][~interest] if analType == 'DE_splicing' else tidy['x'][~interest]
+
+    dict_volcano = {
+        'i_X'         : tidy['x'][interest].tolist(),
+        'i_Y'         : Y[interest].tolist(),
+        'ni_X'        : ni_X.tolist(),
+        'ni_Y'        : Y[~interest].tolist(),
+        'geneSymbols' : tidy['label'][interest].tolist(),
+        'ni_geneSymbols' : tidy['label'][~interest].tolist(), # Only used by the html report
+        'AS_list'     : tidy['event'][interest].tolist() if analType == 'DE_splicing' else [],
+        }
+    hits = tidy[sig]
+    return dict_volcano, hits['gene_key'].dropna().unique(), hits['label'][hits['label'].map(type) == str].tolist()
+
+def thin_out(x, y, n_max, bins=100):
+    '''
+    Positions of at most n_max of the points (x, y): one point per cell of a bins x bins grid, so dense areas are thinned and outliers kept.
+    The grid is made finer while that leaves fewer than half of n_max points (e.g. when a few outliers stretch the axes).
+    '''
+    if len(x) <= n_max:
+        return np.arange(len(x))
+    x = np.nan_to_num(x)
+    y = np.nan_to_num(y)
+    while True:
+        cell_x = np.digitize(x, np.linspace(x.min(), x.max(), bins))
+        cell_y = np.digitize(y, np.linspace(y.min(), y.max(), bins))
+        keep = np.sort(np.unique(cell_x*(bins + 2) + cell_y, return_index=True)[1])
+        if len(keep) >= n_max/2 or bins >= 10000:
+            break
+        bins *= 2
+    if len(keep) > n_max:
+        keep = keep[np.linspace(0, len(keep) - 1, n_max).astype(int)]
+    return keep
+
+def html_points(dict_volcano, analType):
+    '''The points of one volcano as plotted, compacted for the html report: coordinates as base64 float32 (highlighted points first), labels as text'''
+    keep = thin_out(np.asarray(dict_volcano['ni_X'], dtype=float), np.asarray(dict_volcano['ni_Y'], dtype=float), html_max_background)
+    x = np.concatenate([dict_volcano['i_X'], np.asarray(dict_volcano['ni_X'], dtype=float)[keep]]).astype(np.float32)
+    y = np.concatenate([dict_volcano['i_Y'], np.asarray(dict_volcano['ni_Y'], dtype=float)[keep]]).astype(np.float32)
+    labels = dict_volcano['geneSymbols'] + [dict_volcano['ni_geneSymbols'][i] for i in keep]
+    return {
+        'type'  : analType,
+        'x'     : base64.b64encode(x.tobytes()).decode(),
+        'y'     : base64.b64encode(y.tobytes()).decode(),
+        'hits'  : len(dict_volcano['i_X']),
+        'total' : len(dict_volcano['i_X']) + len(dict_volcano['ni_X']),
+        'labels': [str(label) for label in labels],
+        'events': dict_volcano['AS_list'],
+        }
 
 
 # Iterating through the dataframes and generating graphs
@@ -603,166 +1481,582 @@ print()
 print('Genes searched:')
 print(' '.join(sorted([s.upper() for s in genes_of_interest])))
 
+# genes_of_interest are normalised the same way as the gene_key column of every dataframe
+query_keys = set(normalise_symbols(genes_of_interest).dropna())
+resolved_aliases = {gene: key for gene, key in zip(genes_of_interest, normalise_symbols(genes_of_interest)) if str(gene).upper() != key}
+if resolved_aliases:
+    print('Searched as: ' + ' '.join('%s->%s' %(gene, key) for gene, key in resolved_aliases.items()))
+df_regions = parse_regions(regions_of_interest)
+if len(df_regions):
+    print('Regions searched: %i' %(len(df_regions)))
+
+# =============================================================================
+# Sharded runs
+# =============================================================================
+# A shard scans (and plots) only its share of the dataframes, then saves its partial results and stops. The merging run scans nothing,
+# combines the partial results of all shards and carries on as if it had scanned everything itself, so the report and pdf are the same as for a single run.
+def get_shards(n):
+    '''Deals the dataframes out over n shards (round robin over pages, or over dataframes) and returns {df_key: shard index}'''
+    groups = {}
+    if shard_by == 'page':
+        for page, plot_names in dict_pdf_layout.items():
+            for df_key in plot_names:
+                groups.setdefault(dict_aliases.get(df_key, df_key), page)
+    groups = {df_key: groups.get(df_key, df_key) for df_key in dict_sources if df_key not in dict_aliases}
+    group_index = {group: i for i, group in enumerate(dict.fromkeys(groups.values()))}
+    return {df_key: group_index[group] % n for df_key, group in groups.items()}
+
+def run_shards_locally(n):
+    '''Runs this script once per shard in n parallel processes and waits for them to finish'''
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=dict(os.environ, IL_SHARD='%i/%i' %(i, n))) for i in range(n)]
+    failed = [i for i, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        raise RuntimeError('Shards %s failed' %(failed))
+
+def merge_shard_results(n):
+    for i in range(n):
+        with open(os.path.join(shard_dir, 'shard_%i.pkl' %(i)), 'rb') as f:
+            partial = pickle.load(f)
+        dict_gene_summary.update(partial['dict_gene_summary'])
+        dict_hits.update(partial['dict_hits'])
+        plot_path_list.extend(partial['plot_path_list'])
+        list_region_hits.extend(partial['list_region_hits'])
+        dict_html.update(partial['dict_html'])
+    # Same order as a single run (the order of dict_df), so that everything printed and saved afterwards is identical
+    for results in [dict_gene_summary, dict_hits, dict_html]:
+        results_ordered = {df_key: results[df_key] for df_key in dict_sources if df_key in results}
+        results.clear()
+        results.update(results_ordered)
+    list_region_hits.sort(key=lambda df_region_hits: list(dict_sources).index(df_region_hits['dataset'].iloc[0]) if len(df_region_hits) else 0)
+    for hit_keys in dict_hits.values(): # Counted as in the scan loop, so genes with equal counts come out in the same order
+        for gene_key in hit_keys:
+            appearances[gene_key] = appearances.get(gene_key, 0) + 1
+    plot_order = {df_key: i for i, df_key in enumerate(dict_sources)}
+    plot_path_list.sort(key=lambda path: plot_order.get(os.path.basename(path).replace('.png', ''), len(plot_order)))
+
+merge = int(os.environ.get('IL_MERGE', 0)) # Number of shards to merge if this process merges them
+if shard is None and merge == 0 and n_shards > 1:
+    print('\n--- Scanning in %i processes ---' %(n_shards))
+    run_shards_locally(n_shards)
+    merge = n_shards
+
+if shard is not None:
+    shard_index, shard_count = [int(i) for i in shard.split('/')]
+    scan_keys = {df_key for df_key, i in get_shards(shard_count).items() if i == shard_index}
+    print('Shard %i of %i: scanning %i dataframes' %(shard_index + 1, shard_count, len(scan_keys)))
+elif merge:
+    scan_keys = set() # Everything was scanned by the shards
+else:
+    scan_keys = set(dict_df)
+
 #Here we loop through each dataframe and feed the necessary data to the Volcano function
-for df_key in dict_df:
-    df = dict_df[df_key]
-    unbiased_geneSymbols = []
+dict_gene_summary = {} # One row per gene for every dataframe (see summarise_genes). Used by the cross-dataset analyses below
+dict_hits         = {} # gene_keys of all significant genes in every dataframe, regardless of genes_of_interest
+dict_html         = {} # Points of every plotted dataframe for the html report (if make_html)
+list_region_hits  = [] # Events and peaks overlapping regions_of_interest, one dataframe per scanned dataframe
+
+def scan_stage(df_key, df):
+    '''Everything the scan of one dataframe computes, without touching the results of other dataframes or plotting (so it can run in another thread)'''
+    analType = get_analType(df_key)
+    tidy = tidy_dataset(df_key, df)
+    scanned = {'analType': analType, 'summary': summarise_genes(tidy), 'region_hits': None}
+    region_rows = ()
+    if len(df_regions) and 'chrom' in tidy:
+        df_region_hits, region_rows = region_hits(tidy, df_regions, get_region_index(df_key, tidy))
+        scanned['region_hits'] = df_region_hits.assign(dataset=df_key, significant=is_significant(df_region_hits, analType))
+    scanned['dict_volcano'], scanned['hit_keys'], scanned['unbiased_geneSymbols'] = scan_dataset(df_key, tidy, query_keys, region_rows)
+    scanned['plot'] = only_plot_if_sign == False or len(scanned['dict_volcano']['i_Y']) > 0
+    if make_html and scanned['plot']:
+        scanned['html'] = html_points(scanned['dict_volcano'], analType)
+    return scanned
+
+def render_stage(df_key, scanned):
+    '''Adds the scan of one dataframe to the results and plots it. Runs in the main thread (matplotlib is not thread-safe).'''
+    dict_gene_summary[df_key] = scanned['summary']
+    if scanned['region_hits'] is not None:
+        list_region_hits.append(scanned['region_hits'])
+    dict_hits[df_key] = scanned['hit_keys']
+    for gene_key in scanned['hit_keys']:
+        appearances[gene_key] = appearances.get(gene_key, 0) + 1
+
+    if scanned['plot']:
+        Volcano(scanned['dict_volcano'], df_key, scanned['analType'])
+    else:
+        print(f'skipping {df_key}: no significant events found')
+    if 'html' in scanned:
+        dict_html[df_key] = scanned['html']
 
-    # If we are dealing with differential splicing
-    if 'rMATS' in df_key:
-        genes_of_interest_mod = [s.upper() for s in genes_of_interest]
-        alreadyAdded = []
-        # if print_gene_names:
-        #     print('Gene,Event,FDR,PSIdiff')
-        dict_volcano = {'ni_X' : [], 'ni_Y' : [], 'i_X' : [], 'i_Y' : [], 'geneSymbols': []}
-        AS_list	     = []
-        for index, row in df.iterrows():
-            gene = str(row['geneSymbol']).upper()
-            # pval = row['PValue']
-            FDR  = row['FDR']
-            PSI  = row['IncLevelDifference']
-            SplE = row['Splicing Event']
-            PSI = PSI * -1
-            if SplE == 'SE': # There is discussion whether skipped exon events need to be flipped
-                PSI = PSI * -1
-            line = '%s,%s,%.3f,%.3f' %(gene, SplE, FDR, PSI)
-            if 'nan' in line:
-                continue
-            if gene.upper() in genes_of_interest_mod and FDR < thresh_FDR and abs(PSI) >= thresh_PSI:
-                # if print_gene_names:
-                #     print(line)
-                dict_volcano['i_X'].append(PSI)
-                dict_volcano['i_Y'].append(-math.log10(pval_Clamper(FDR)))
-                dict_volcano['geneSymbols'].append(gene)
-                AS_list.append(SplE)
-            else:
-                dict_volcano['ni_X'].append(-PSI)
-                dict_volcano['ni_Y'].append(-math.log10(pval_Clamper(FDR)))
-            if unbiased:
-                if FDR < thresh_FDR and abs(PSI) >= thresh_PSI:
-                    if type(gene) == type(''):
-                        unbiased_geneSymbols.append(str(gene))
-            if  FDR < thresh_FDR and abs(PSI) >= thresh_PSI:
-                add_appearance(gene, alreadyAdded)
-        if only_plot_if_sign == False:
-            Volcano(dict_volcano, df_key, "DE_splicing")
-        elif only_plot_if_sign and len(dict_volcano['i_Y']) > 0:
-            Volcano(dict_volcano, df_key, "DE_splicing")
-        else:
-            print(f'skipping {df_key}: no significant events found')
+    if unbiased:
+        print()
+        print("Hits with no prefiltering based on genenames:")
+        print('\n'.join(scanned['unbiased_geneSymbols']))
+
+# With pipeline_stages, reading and scanning run in two threads that hand dataframes on through queues of pipeline_depth, and the main thread plots.
+# A full queue makes the stage before it wait, so no more than a few dataframes are in flight. Each stage handles the dataframes in the same order,
+# so the plots (and the pdf) come out exactly as without the pipeline. An error in a thread is passed on and raised in the main thread.
+# Without pool_budget_mb, each dataframe is released from the pool once it is scanned, so only the dataframes in flight are held in memory.
+def run_stage(work, q_in, q_out):
+    for item in iter(q_in.get, None):
+        try:
+            q_out.put((item[0], work(*item)))
+        except BaseException as error:
+            q_out.put((item[0], error))
+            break
+    q_out.put(None)
+
+def scan_and_release(df_key, df):
+    scanned = scan_stage(df_key, df)
+    if pool_budget_mb is None: # With a budget, the pool evicts dataframes itself
+        dict_df.release(df_key)
+    return scanned
+
+def run_pipeline(df_keys):
+    q_keys, q_read, q_scan = queue.Queue(), queue.Queue(maxsize=pipeline_depth), queue.Queue(maxsize=pipeline_depth)
+    for df_key in df_keys:
+        q_keys.put((df_key,))
+    q_keys.put(None)
+    threads = [threading.Thread(target=run_stage, args=(lambda df_key: dict_df[df_key], q_keys, q_read), daemon=True),
+               threading.Thread(target=run_stage, args=(lambda df_key, df: df if isinstance(df, BaseException) else scan_and_release(df_key, df), q_read, q_scan), daemon=True)]
+    for thread in threads:
+        thread.start()
+    for df_key, scanned in iter(q_scan.get, None):
+        if isinstance(scanned, BaseException):
+            raise scanned
+        render_stage(df_key, scanned)
+
+with dataset_lock: # Watch mode does not refresh dict_df during the scan
+    scan_order = []
+    for df_key in dict_df:
+        if df_key in dict_aliases: # Same content as another dataframe: scanned (and plotted) under that name only
+            continue
+        if df_key not in scan_keys: # Scanned by another shard
+            continue
+        if get_analType(df_key) is None:
+            print('\n!!data type not found for %s!!' %(df_key))
+            continue
+        scan_order.append(df_key)
 
-    # If we are looking at differential expression
-    elif 'edgeR' in df_key or 'deseq' in df_key or 'ATAC' in df_key:
-        genes_of_interest_mod = [s.upper() for s in genes_of_interest]
-        alreadyAdded = []
-        # if print_gene_names:
-        #     print('Gene,pVal,log2FC')
-        dict_volcano = {'ni_X' : [], 'ni_Y' : [], 'i_X' : [], 'i_Y' : [], 'geneSymbols': []}
-        for index, row in df.iterrows():
-            if 'edgeR' in df_key:
-                gene = str(row['geneSymbol']).upper()
-                l2FC = row['log2FC']
-            elif 'deseq' in df_key:
-                gene = str(row['gene_symbol']).upper()
-                l2FC = row['log2FoldChange']
-            elif 'ATAC' in df_key:
-                gene = str(row['Gene Name']).upper()
-                l2FC = row['log2FoldChange']
-            pval = float(row['padj'])
-            line = '%s,%.3f,%.3f' %(gene, pval, l2FC)
-            if gene.upper() in genes_of_interest_mod and pval < thresh_pval and abs(l2FC) >= thresh_l2FC:
-                # if print_gene_names:
-                #     print(line)
-                dict_volcano['i_X'].append(l2FC)
-                dict_volcano['i_Y'].append(-math.log10(pval_Clamper(pval)))
-                dict_volcano['geneSymbols'].append(gene)
-            else:
-                dict_volcano['ni_X'].append(l2FC)
-                dict_volcano['ni_Y'].append(-math.log10(pval_Clamper(pval)))
-            if unbiased:
-                if pval < thresh_pval and abs(l2FC) >= thresh_l2FC:
-                    if type(gene) == type(''):
-                        unbiased_geneSymbols.append(str(gene))
-            if pval < thresh_pval and abs(l2FC) >= thresh_l2FC:
-                add_appearance(gene, alreadyAdded)
-        if only_plot_if_sign == False:
-            Volcano(dict_volcano, df_key, "DE_expression")
-        elif only_plot_if_sign and len(dict_volcano['i_Y']) > 0:
-            Volcano(dict_volcano, df_key, "DE_expression")
-        else:
-            print(f'skipping {df_key}: no significant events found')
+    if pipeline_stages:
+        run_pipeline(scan_order)
+    else:
+        for df_key in scan_order:
+            render_stage(df_key, scan_stage(df_key, dict_df[df_key]))
 
-    # If we are looking at proteomics data
-    elif 'proteomics' in df_key:
-        genes_of_interest_mod = [s.capitalize() for s in genes_of_interest]
-        alreadyAdded = []
-        # if print_gene_names:
-        #     print('Gene,pVal,log2FC')
-        dict_volcano = {'ni_X' : [], 'ni_Y' : [], 'i_X' : [], 'i_Y' : [], 'geneSymbols': []}
-        for index, row in df.iterrows():
-            if 'perseus' in df_key:
-                gene = str(row['Genes']).capitalize() 
-                try:
-                    l2FC = row['Difference'] # maxquant
-                    neglogpval = row['-Log(P-value)']
-                    pval = 10**(-1*neglogpval)
-                except:
-                    pval=row['neglogpval']
-                    l2FC=row['log2FC']
-            elif 'TALL_proteomics' in df_key:
-                gene = str(row['Gene names']).capitalize()
-                l2FC = row['log2FC']
-                pval = row['adj P Val_T ALLvsThymus_']
-            elif 'RPB1_v_IgG_IP' in df_key:
-                gene = row['Genes']
-                l2FC = row['log2FC']
-                pval = row['p-value']
-            elif 'Freya' in df_key or 'Kevin' in df_key:
-                gene = row['Genes']
-                l2FC = row['logFC']
-                pval = row['adj.P.Val']
-            elif '_STM' in df_key:
-                gene = row['Gene']
-                l2FC = row['log2FC']
-                pval = row['FDR']
-            else:
-                gene = str(row['GeneSymbol']).capitalize()
-                l2FC = row['log2FC']
-                neglogpval = row['neglogPVal']
-                pval = 10**(-1*neglogpval)
-            line = '%s,%.3f,%.3f' %(gene, pval, l2FC)
-            if str(gene).capitalize() in genes_of_interest_mod and pval < thresh_pval and abs(l2FC) >= thresh_l2FC:
-                # if print_gene_names:
-                #     print(line)
-                dict_volcano['i_X'].append(l2FC)
-                dict_volcano['i_Y'].append(-math.log10(pval_Clamper(pval)))
-                dict_volcano['geneSymbols'].append(gene)
-            else:
-                dict_volcano['ni_X'].append(l2FC)
-                dict_volcano['ni_Y'].append(-math.log10(pval_Clamper(pval)))
-            if unbiased:
-                if pval < thresh_pval and abs(l2FC) >= thresh_l2FC:
-                    if type(gene) == type(''):
-                        unbiased_geneSymbols.append(str(gene))
-            if pval < thresh_pval and abs(l2FC) >= thresh_l2FC:
-                if type(gene) == type(''):
-                    add_appearance(gene, alreadyAdded)
-        if only_plot_if_sign == False:
-            Volcano(dict_volcano, df_key, "DE_proteomics")
-        elif only_plot_if_sign and len(dict_volcano['i_Y']) > 0:
-            Volcano(dict_volcano, df_key, "DE_proteomics")
-        else:
-            print(f'skipping {df_key}: no significant events found')
+if shard is not None:
+    os.makedirs(shard_dir, exist_ok=True)
+    partial = {'dict_gene_summary': dict_gene_summary, 'dict_hits': dict_hits, 'plot_path_list': plot_path_list, 'list_region_hits': list_region_hits, 'dict_html': dict_html}
+    with open(os.path.join(shard_dir, 'shard_%i.pkl' %(shard_index)), 'wb') as f:
+        pickle.dump(partial, f)
+    print('Shard %i of %i done' %(shard_index + 1, shard_count))
+    sys.exit(0)
+elif merge:
+    merge_shard_results(merge)
+    print('Merged the results of %i shards' %(merge))
+
+if list_region_hits:
+    df_region_hits = pd.concat(list_region_hits)
+    df_region_hits = df_region_hits[['region', 'dataset', 'label', 'event', 'chrom', 'start', 'end', 'x', 'p', 'significant'] if 'event' in df_region_hits else
+                                    ['region', 'dataset', 'label', 'chrom', 'start', 'end', 'x', 'p', 'significant']]
+    df_region_hits.to_csv(os.path.join(out_dir, 'regions_of_interest_hits.tsv'), sep='\t', index=False)
+    print('%i events and peaks overlap regions_of_interest (%i significant), saved as %s'
+          %(len(df_region_hits), df_region_hits['significant'].sum(), os.path.join(out_dir, 'regions_of_interest_hits.tsv')))
+
+
+if isinstance(dict_df, DatasetPool):
+    print('Dataset pool: %(hits)i hits, %(misses)i misses, %(evictions)i evictions, %(resident)i dataframes (%(resident_mb)s MB) in memory' %(dict_df.stats()))
+
+
+# =============================================================================
+# Concordance between datasets
+# =============================================================================
+# The signed effect of every gene (see summarise_genes) in every dataframe is put in one gene x dataset matrix, aligned on gene_key.
+# All pairwise correlations between datasets are then computed at once with matrix products over the genes both datasets measured.
+# For Spearman, both datasets of a pair are ranked over the genes they share. Each dataset is sorted once: its ranks within the genes of any other dataset
+# then follow from cumulative counts along that order (ties get their average rank), so all pairs are ranked with a few array passes and no further sorting.
+
+def effect_matrix(df_keys, value='x'):
+    return pd.concat({df_key: dict_gene_summary[df_key][value] for df_key in df_keys}, axis=1)
+
+def subset_ranks(q, first, last):
+    '''Ranks of a dataset's sorted values among the positions where q (one row per subset of genes). first/last mark where runs of tied values start and end.'''
+    counts = np.cumsum(q, axis=1, dtype=np.int32)
+    before = np.maximum.accumulate(np.where(first, counts - q, 0), axis=1) # Kept in q before the run of each value
+    upto   = np.minimum.accumulate(np.where(last, counts, q.shape[1])[:, ::-1], axis=1)[:, ::-1] # Kept in q up to the end of the run
+    return np.where(q, (before + upto + 1) / 2, 0)
+
+def pairwise_spearman(matrix, min_genes=50):
+    X = matrix.to_numpy(dtype=float).T # One row per dataset
+    M = ~np.isnan(X)
+    order   = np.argsort(X, axis=1) # Missing values sort last
+    rank_of = np.argsort(order, axis=1) # Position of each gene in the order of its dataset
+    X_sorted = np.take_along_axis(X, order, axis=1)
+    first = np.ones(X.shape, dtype=bool)
+    first[:, 1:] = X_sorted[:, 1:] != X_sorted[:, :-1]
+    last  = np.ones(X.shape, dtype=bool)
+    last[:, :-1] = first[:, 1:]
+    n = M.astype(float) @ M.T
+    r = np.full(n.shape, np.nan)
+    for i in range(len(X)):
+        # A: ranks of dataset i within the genes of each later dataset j. B: ranks of each dataset j within the genes of i. Both in gene order.
+        A = subset_ranks(M[i:, order[i]] & M[i, order[i]], first[i], last[i])[:, rank_of[i]]
+        B = np.take_along_axis(subset_ranks(M[i][order[i:]] & np.take_along_axis(M[i:], order[i:], axis=1), first[i:], last[i:]), rank_of[i:], axis=1)
+        n_ij = n[i, i:]
+        mean = (n_ij + 1) / 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r[i, i:] = (np.einsum('ij,ij->i', A, B) - n_ij*mean**2) / np.sqrt((np.einsum('ij,ij->i', A, A) - n_ij*mean**2) * (np.einsum('ij,ij->i', B, B) - n_ij*mean**2))
+        r[i:, i] = r[i, i:]
+    r[n < min_genes] = np.nan
+    return pd.DataFrame(r, index=matrix.columns, columns=matrix.columns)
+
+def pairwise_correlation(matrix, method='spearman', min_genes=50):
+    if method == 'spearman':
+        return pairwise_spearman(matrix, min_genes)
+    X  = matrix.to_numpy(dtype=float)
+    M  = (~np.isnan(X)).astype(float)
+    X0 = np.nan_to_num(X)
+    n   = M.T @ M             # n[i,j]   = genes measured in both i and j
+    sx  = X0.T @ M            # sx[i,j]  = sum of i over the genes shared with j (sx.T holds the sums of j)
+    sxx = (X0**2).T @ M
+    sxy = X0.T @ X0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = (n*sxy - sx*sx.T) / np.sqrt((n*sxx - sx**2) * (n*sxx - sx**2).T)
+    r[n < min_genes] = np.nan
+    return pd.DataFrame(r, index=matrix.columns, columns=matrix.columns)
+
+def plot_concordance(df_concordance, method):
+    order = list(df_concordance.index)
+    try:
+        from scipy.cluster.hierarchy import linkage, leaves_list
+        from scipy.spatial.distance import squareform
+        distances = (1 - df_concordance.fillna(0).to_numpy()).clip(0, 2)
+        np.fill_diagonal(distances, 0)
+        order = [order[i] for i in leaves_list(linkage(squareform(distances, checks=False), method='average'))]
+    except ImportError:
+        print('scipy not found: concordance heatmap is not clustered')
+    df_ordered = df_concordance.loc[order, order]
+
+    plt.figure(figsize=(20,20))
+    plt.imshow(df_ordered.to_numpy(), cmap='RdBu_r', vmin=-1, vmax=1)
+    plt.colorbar(shrink=0.6).set_label('%s correlation of effect sizes' %(method.capitalize()), fontsize=4*scale_factor)
+    plt.xticks(range(len(order)), order, rotation=90, fontsize=6)
+    plt.yticks(range(len(order)), order, fontsize=6)
+    plt.title('Concordance between datasets', fontsize=8*scale_factor)
+    plt.tight_layout()
+    path_file_out = os.path.join(out_dir, 'Concordance_%s.png' %(method))
+    plot_path_list.append(path_file_out)
+    dict_pdf_layout['Concordance between datasets'].append(os.path.basename(path_file_out).split('.png')[0])
+    plt.savefig(path_file_out)
+    plt.show()
+    plt.close()
 
+if make_concordance_page:
+    concordance_keys = list(dict_gene_summary)
+    signature = {'datasets': [source_signature(df_key) for df_key in concordance_keys], 'method': concordance_method, 'min_genes': concordance_min_genes}
+    df_concordance = cached_table('concordance_%s' %(concordance_method), signature,
+                                  lambda: pairwise_correlation(effect_matrix(concordance_keys), concordance_method, concordance_min_genes), version=2) # 2: Spearman ranks each pair over its shared genes
+    print('Concordance between datasets (%s) saved as %s' %(concordance_method, os.path.join(out_dir, 'concordance_%s.tsv' %(concordance_method))))
+    plot_concordance(df_concordance, concordance_method)
+
+
+# =============================================================================
+# Enrichment of the hits of each dataset
+# =============================================================================
+# Every dataset's hits are tested against every gene set of the local MSigDB release (see get_msigdb) with a hypergeometric test. The background of a dataset is the genes it measured.
+# All datasets are tested in one pass: gene set membership, backgrounds and hits are sparse matrices, so the overlaps for every
+# gene set x dataset pair come out of two matrix products and the p-values out of one vectorised call.
+
+def fdr_bh(pvals):
+    '''Benjamini-Hochberg FDR of each column of a 2D array. NaNs (untested) are ignored and stay NaN.'''
+    pvals   = np.asarray(pvals, dtype=float)
+    order   = np.argsort(np.where(np.isnan(pvals), np.inf, pvals), axis=0)
+    ranked  = np.take_along_axis(pvals, order, axis=0)
+    n_tests = (~np.isnan(pvals)).sum(axis=0)
+    q = np.nan_to_num(ranked * n_tests / np.arange(1, len(pvals) + 1)[:, None], nan=np.inf)
+    q = np.minimum(np.minimum.accumulate(q[::-1], axis=0)[::-1], 1)
+    q[np.isnan(ranked)] = np.nan
+    fdr = np.empty_like(q)
+    np.put_along_axis(fdr, order, q, axis=0)
+    return fdr
+
+def batched_enrichment(gene_sets, dict_background, dict_hits, set_sizes=(10, 500)):
+    '''Returns the p-values and FDRs (gene set x dataset) of the enrichment of each dataset's hits in each gene set, and the overlaps (long format)'''
+    from scipy import sparse
+    from scipy.stats import hypergeom
+
+    df_keys  = list(dict_hits)
+    set_keys = [normalise_symbols(genes).dropna().unique() for genes in gene_sets.values()]
+    universe = pd.Index(np.unique(np.concatenate(set_keys + [np.asarray(dict_background[df_key], dtype=object) for df_key in df_keys])))
+
+    def membership(lists): # Sparse matrix with one column per list and a 1 for every gene in it
+        rows = np.concatenate([universe.get_indexer(np.asarray(genes, dtype=object)) for genes in lists])
+        cols = np.repeat(np.arange(len(lists)), [len(genes) for genes in lists])
+        return sparse.csc_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(universe), len(lists)))
+
+    S = membership(set_keys).T.tocsr()
+    B = membership([dict_background[df_key] for df_key in df_keys])
+    H = membership([dict_hits[df_key] for df_key in df_keys])
+    set_size = (S @ B).toarray() # Genes of each set measured in each dataset
+    overlap  = (S @ H).toarray() # Hits of each dataset in each set
+    n_background = np.asarray(B.sum(axis=0)).ravel()
+    n_hits       = np.asarray(H.sum(axis=0)).ravel()
+
+    pvals = hypergeom.sf(overlap - 1, n_background[None, :], set_size, n_hits[None, :])
+    pvals[(set_size < set_sizes[0]) | (set_size > set_sizes[1]) | (n_hits[None, :] == 0)] = np.nan
+    df_pvals = pd.DataFrame(pvals, index=list(gene_sets), columns=df_keys)
+    df_fdr   = pd.DataFrame(fdr_bh(pvals), index=list(gene_sets), columns=df_keys)
+
+    df_long = pd.DataFrame({
+        'dataset'    : np.tile(df_keys, len(gene_sets)),
+        'gene_set'   : np.repeat(list(gene_sets), len(df_keys)),
+        'overlap'    : overlap.ravel().astype(int),
+        'set_size'   : set_size.ravel().astype(int),
+        'hits'       : np.tile(n_hits, len(gene_sets)).astype(int),
+        'background' : np.tile(n_background, len(gene_sets)).astype(int),
+        'pval'       : pvals.ravel(),
+        'FDR'        : df_fdr.to_numpy().ravel(),
+        })
+    return df_pvals, df_fdr, df_long.dropna(subset=['pval'])
+
+if run_enrichment:
+    all_gene_sets, names = get_msigdb(enrichment_db_version)
+    if enrichment_prefixes is not None:
+        names = [name for prefix in enrichment_prefixes for name in search_gene_sets(prefix, enrichment_db_version)]
+    gene_sets = {name: all_gene_sets[name] for name in dict.fromkeys(names)}
+if run_enrichment and not gene_sets:
+    print('\nNo MSigDB %s gene sets found in %s: enrichment skipped' %(enrichment_db_version, msigdb_dir))
+elif run_enrichment:
+    print('\n--- Enrichment of the hits of %i datasets in %i gene sets ---' %(len(dict_hits), len(gene_sets)))
+    dict_background = {df_key: dict_gene_summary[df_key].index for df_key in dict_hits}
+    df_enrichment_pvals, df_enrichment_FDR, df_enrichment = batched_enrichment(gene_sets, dict_background, dict_hits, enrichment_set_sizes)
+    df_enrichment = df_enrichment[df_enrichment['FDR'] < thresh_enrichment_FDR].sort_values(['dataset', 'FDR'])
+    df_enrichment_FDR.to_csv(os.path.join(out_dir, 'enrichment_FDR.tsv'), sep='\t')
+    df_enrichment.to_csv(os.path.join(out_dir, 'enrichment_significant.tsv'), sep='\t', index=False)
+    for df_key, df_top in df_enrichment.groupby('dataset', sort=False):
+        print(df_key + ': ' + ', '.join(df_top['gene_set'].head(5)))
+    print('Enrichment tables saved in %s' %(out_dir))
+
+
+# =============================================================================
+# Meta-analysis across datasets
+# =============================================================================
+# Each gene's p-value in each dataframe (see summarise_genes) is turned into a signed Z (the sign of its effect), and the Z's are combined across dataframes
+# with Stouffer's method (signed, so genes that move in opposite directions cancel out) and the p-values with Fisher's method (unsigned).
+# Everything is computed at once on the gene x dataset matrices from effect_matrix, with NaN where a gene was not measured.
+# Note that the p column of splicing dataframes is an FDR and that x is dPSI there, so mixing data types is best done with some care.
+
+def get_meta_keys(names):
+    '''Dataframes to combine: names can be dataframes or pages of dict_pdf_layout. Duplicates and dataframes that were not scanned are left out.'''
+    if names is None:
+        return list(dict_gene_summary)
+    df_keys = []
+    for name in names:
+        df_keys += dict_pdf_layout.get(name, [name])
+    df_keys = [dict_aliases.get(df_key, df_key) for df_key in df_keys]
+    return [df_key for df_key in dict.fromkeys(df_keys) if df_key in dict_gene_summary]
+
+def meta_analysis(df_keys, weights=None, min_datasets=3):
+    '''One row per gene: Stouffer's (weighted) signed Z, Fisher's combined p-value, their FDRs and how many dataframes have the gene going up or down'''
+    from scipy.stats import norm, chi2
+
+    X = effect_matrix(df_keys, 'x')
+    P = effect_matrix(df_keys, 'p').reindex(X.index)
+    x = X.to_numpy(dtype=float)
+    p = P.to_numpy(dtype=float).clip(1e-300, 1)
+    measured = ~(np.isnan(x) | np.isnan(p))
+    w = np.array([1.0 if weights is None else float(weights.get(df_key, 1)) for df_key in df_keys])
+    W = np.where(measured, w[None, :], 0)
+
+    z = np.where(measured, np.sign(np.nan_to_num(x)) * norm.isf(np.nan_to_num(p, nan=1)/2), 0) # Signed Z from the two-sided p-value
+    n_datasets = measured.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stouffer_z = (W*z).sum(axis=1) / np.sqrt((W**2).sum(axis=1))
+    stouffer_p = 2*norm.sf(np.abs(stouffer_z))
+    fisher_p   = chi2.sf(-2*np.where(measured, np.log(np.nan_to_num(p, nan=1)), 0).sum(axis=1), 2*n_datasets)
+
+    df_meta = pd.DataFrame({
+        'gene'        : pd.concat({df_key: dict_gene_summary[df_key]['label'] for df_key in df_keys}, axis=1).reindex(X.index).bfill(axis=1).iloc[:, 0],
+        'n_datasets'  : n_datasets,
+        'n_up'        : (measured & (x > 0)).sum(axis=1),
+        'n_down'      : (measured & (x < 0)).sum(axis=1),
+        'mean_effect' : np.nanmean(np.where(measured, x, np.nan), axis=1),
+        'stouffer_Z'  : stouffer_z,
+        'stouffer_p'  : stouffer_p,
+        'fisher_p'    : fisher_p,
+        }, index=X.index)
+    df_meta = df_meta[df_meta['n_datasets'] >= min_datasets].copy()
+    df_meta['consistency']  = df_meta[['n_up', 'n_down']].max(axis=1) / df_meta['n_datasets'] # Fraction of dataframes that agree on the direction
+    df_meta['stouffer_FDR'] = fdr_bh(df_meta[['stouffer_p']].to_numpy())[:, 0]
+    df_meta['fisher_FDR']   = fdr_bh(df_meta[['fisher_p']].to_numpy())[:, 0]
+    df_meta.index.name = 'gene_key'
+    return df_meta.sort_values(['stouffer_p', 'fisher_p'], kind='stable')
+
+if run_meta_analysis:
+    meta_keys = get_meta_keys(meta_datasets)
+    print('\n--- Meta-analysis of %i datasets ---' %(len(meta_keys)))
+    signature = {'datasets': [source_signature(df_key) for df_key in meta_keys], 'weights': meta_weights, 'min_datasets': meta_min_datasets, 'aliases': gene_aliases_version}
+    df_meta = cached_table('meta_analysis', signature, lambda: meta_analysis(meta_keys, meta_weights, meta_min_datasets))
+    print(df_meta.head(20)[['gene', 'n_datasets', 'n_up', 'n_down', 'stouffer_Z', 'stouffer_FDR', 'fisher_FDR']].to_string())
+    print('Meta-analysis saved as %s' %(os.path.join(out_dir, 'meta_analysis.tsv')))
+
+
+# =============================================================================
+# Multi-omic view per page
+# =============================================================================
+# The dataframes on a page of the pdf are joined on gene_key (one row per gene, see summarise_genes) with hash joins (pd.merge), giving one table per page
+# with the effect and p-value of every gene in every dataframe. Dataframes of the same layer (RNA, protein, splicing, chromatin) are averaged into one column per layer.
+# A gene of interest is concordant if it is significant in RNA and protein in the same direction, and discordant if in opposite directions.
+
+def get_layer(df_key):
+    if 'ATAC' in df_key:
+        return 'chromatin'
+    return {'DE_expression': 'RNA', 'DE_proteomics': 'protein', 'DE_splicing': 'dPSI'}.get(get_analType(df_key))
+
+def join_page(df_keys):
+    '''One row per gene measured in any of df_keys: label, x_<df_key> and p_<df_key> per dataframe, the mean effect per layer and whether it is significant there'''
+    frames = [dict_gene_summary[df_key].assign(sig=is_significant(dict_gene_summary[df_key], get_analType(df_key)))
+              .rename(columns={'label': 'label_' + df_key, 'x': 'x_' + df_key, 'p': 'p_' + df_key, 'sig': 'sig_' + df_key}) for df_key in df_keys]
+    df_joined = frames[0]
+    for frame in frames[1:]:
+        df_joined = pd.merge(df_joined, frame, how='outer', left_index=True, right_index=True)
+    labels = df_joined[['label_' + df_key for df_key in df_keys]]
+    df_joined.insert(0, 'gene', labels.bfill(axis=1).iloc[:, 0])
+    df_joined = df_joined.drop(columns=labels.columns)
+
+    for layer in dict.fromkeys(get_layer(df_key) for df_key in df_keys):
+        layer_keys = [df_key for df_key in df_keys if get_layer(df_key) == layer]
+        df_joined[layer] = df_joined[['x_' + df_key for df_key in layer_keys]].mean(axis=1)
+        sig = df_joined[['sig_' + df_key for df_key in layer_keys]].fillna(False).astype(bool)
+        df_joined['sig_' + layer] = sig.any(axis=1)
+    df_joined = df_joined.drop(columns=['sig_' + df_key for df_key in df_keys])
+
+    df_joined['of_interest'] = df_joined.index.isin(query_keys)
+    df_joined['status'] = ''
+    if 'RNA' in df_joined and 'protein' in df_joined:
+        both = df_joined['sig_RNA'] & df_joined['sig_protein']
+        same = np.sign(df_joined['RNA']) == np.sign(df_joined['protein'])
+        df_joined.loc[both & same, 'status'] = 'concordant'
+        df_joined.loc[both & ~same, 'status'] = 'discordant'
+    df_joined.index.name = 'gene_key'
+    return df_joined
+
+def plot_multiomic(df_joined, page, name):
+    y_layer = 'protein' if 'protein' in df_joined else 'dPSI'
+    df_plot = df_joined.dropna(subset=['RNA', y_layer])
+    colored = y_layer == 'protein' and 'dPSI' in df_plot
+
+    plt.figure(figsize=(10,10))
+    if colored: # Genes without a splicing event stay grey
+        plt.scatter(df_plot['RNA'], df_plot[y_layer], color=c_nint, s=dp_size/10)
+        df_colored = df_plot.dropna(subset=['dPSI'])
+        points = plt.scatter(df_colored['RNA'], df_colored[y_layer], c=df_colored['dPSI'], cmap='coolwarm', vmin=-x_window, vmax=x_window, s=dp_size/5)
+        plt.colorbar(points, shrink=0.6).set_label('ΔPSI', fontsize=6*scale_factor)
     else:
-        print('\n!!data type not found for %s!!' %(df_key))
+        plt.scatter(df_plot['RNA'], df_plot[y_layer], color=c_nint, s=dp_size/5)
+    df_interest = df_plot[df_plot['of_interest']]
+    edge_colors = df_interest['status'].map({'concordant': 'green', 'discordant': 'red'}).fillna('black')
+    plt.scatter(df_interest['RNA'], df_interest[y_layer], color=c_inte, edgecolors=edge_colors, linewidths=2, s=dp_size)
+    if plot_text and len(df_interest): # Label the max_labels genes of interest furthest from the origin
+        df_labelled = df_interest.loc[(df_interest['RNA']**2 + df_interest[y_layer]**2).sort_values(ascending=False).index[:max_labels]]
+        texts = [plt.text(x, y, label, fontsize=6*scale_factor) for x, y, label in zip(df_labelled['RNA'], df_labelled[y_layer], df_labelled['gene'])]
+        adjust_text(texts, arrowprops=dict(arrowstyle='->'), color='black')
+    plt.axhline(0, color='black', alpha=0.5)
+    plt.axvline(0, color='black', alpha=0.5)
+    plt.xlabel('RNA log2(Fold Change)', fontsize=8*scale_factor)
+    plt.ylabel('Protein log2(Fold Change)' if y_layer == 'protein' else 'ΔPSI', fontsize=8*scale_factor)
+    plt.title(textwrap.fill(page, 50) + ('\n(genes of interest outlined green: concordant, red: discordant)' if y_layer == 'protein' else ''), fontsize=5*scale_factor)
+    plt.xticks(fontsize=8*scale_factor)
+    plt.yticks(fontsize=8*scale_factor)
+    path_file_out = os.path.join(out_dir, name + '.png')
+    plot_path_list.append(path_file_out)
+    dict_pdf_layout[page].append(name)
+    plt.tight_layout()
+    plt.savefig(path_file_out)
+    plt.show()
+    plt.close()
 
-    line = ''
+if make_multiomic_pages:
+    for page, plot_names in list(dict_pdf_layout.items()):
+        df_keys = [df_key for df_key in dict.fromkeys(dict_aliases.get(name, name) for name in plot_names) if df_key in dict_gene_summary]
+        layers = {get_layer(df_key) for df_key in df_keys}
+        if 'RNA' not in layers or not layers & {'protein', 'dPSI'}:
+            continue
+        name = 'Multiomic_' + re.sub(r'\W+', '_', page).strip('_')
+        signature = {'datasets': [source_signature(df_key) for df_key in df_keys], 'genes': sorted(query_keys), 'aliases': gene_aliases_version,
+                     'thresholds': [thresh_pval, thresh_FDR, thresh_l2FC, thresh_PSI]}
+        df_joined = cached_table(name, signature, lambda: join_page(df_keys))
+        print('%s: %i genes joined across %i dataframes, %i genes of interest concordant, %i discordant' %(page, len(df_joined), len(df_keys),
+              (df_joined['of_interest'] & (df_joined['status'] == 'concordant')).sum(), (df_joined['of_interest'] & (df_joined['status'] == 'discordant')).sum()))
+        plot_multiomic(df_joined, page, name)
 
-    if unbiased:
-        print()
-        print("Hits with no prefiltering based on genenames:")
-        print('\n'.join(unbiased_geneSymbols))
+
+# =============================================================================
+# Gene cards
+# =============================================================================
+# All per-gene summaries are stacked into one table indexed (and sorted) by gene_key, so everything known about a gene across all datasets
+# is a single index lookup. Each card is a compact forest plot of the effect of one gene in every dataset that measured it.
+
+def build_gene_index(dict_gene_summary):
+    frames = []
+    for df_key, summary in dict_gene_summary.items():
+        frames.append(summary.assign(dataset=df_key, analType=get_analType(df_key), sig=is_significant(summary, get_analType(df_key))))
+    return pd.concat(frames).sort_index()
+
+def plot_gene_card(gene_key, df_gene_index, dataset_pages):
+    rows = df_gene_index.loc[[gene_key]] if gene_key in df_gene_index.index else df_gene_index.iloc[:0]
+    page_order = {page: i for i, page in enumerate(list(dict_pdf_layout) + ['Other'])}
+    rows = rows.assign(page=rows['dataset'].map(lambda df_key: dataset_pages.get(df_key, 'Other')))
+    rows = rows.sort_values('page', key=lambda pages: pages.map(page_order), kind='stable')
+
+    fig, ax = plt.subplots(figsize=(6, max(2, 0.18 * len(rows) + 1)))
+    if len(rows) == 0:
+        ax.text(0.5, 0.5, '%s\nnot found in data' %(gene_key), fontsize=12, ha='center', va='center', color='red', transform=ax.transAxes)
+        ax.axis('off')
+    else:
+        Ys = np.arange(len(rows))[::-1]
+        splicing = (rows['analType'] == 'DE_splicing').to_numpy()
+        colors = np.where(rows['sig'], c_inte, '#a0a0a0')
+        sizes = 10 + 10 * -np.log10(rows['p'].clip(lower=min_pval)).clip(upper=10)
+        ax.scatter(rows['x'][~splicing], Ys[~splicing], c=colors[~splicing], s=sizes[~splicing], marker='o', zorder=3)
+        ax.scatter(rows['x'][splicing], Ys[splicing], c=colors[splicing], s=sizes[splicing], marker='D', zorder=3)
+        ax.hlines(Ys, 0, rows['x'], color='#a0a0a0', lw=0.5)
+        ax.axvline(0, color='black', lw=0.5)
+        thresholds = np.where(splicing, thresh_PSI, thresh_l2FC) # Each row gets the guides of its own data type
+        for sign in [1, -1]:
+            ax.vlines(sign * thresholds, Ys - 0.5, Ys + 0.5, color='black', alpha=0.2, ls='--', lw=0.5)
+        ax.set_yticks(Ys)
+        ax.set_yticklabels(rows['dataset'], fontsize=5)
+        for page, Ys_page in pd.Series(Ys, index=rows['page'].to_numpy()).groupby(level=0, sort=False):
+            ax.axhline(Ys_page.min() - 0.5, color='black', alpha=0.3, lw=0.5)
+            ax.text(1.01, Ys_page.mean(), textwrap.shorten(page, 40), fontsize=4, va='center', transform=ax.get_yaxis_transform())
+        ax.set_ylim(-0.5, len(rows) - 0.5)
+        ax.set_xlabel('log2(Fold Change) (circles) / ΔPSI (diamonds)', fontsize=7)
+        ax.tick_params(axis='x', labelsize=6)
+    ax.set_title('%s (blue: clears the thresholds of significance and size)' %(gene_key), fontsize=8)
+    fig.tight_layout()
+    path_file_out = os.path.join(out_dir, 'GeneCard_%s.png' %(gene_key))
+    plot_path_list.append(path_file_out)
+    dict_pdf_layout['Gene cards'].append(os.path.basename(path_file_out).split('.png')[0])
+    fig.savefig(path_file_out, dpi=150)
+    plt.close(fig)
+
+if make_gene_cards:
+    df_gene_index = build_gene_index(dict_gene_summary)
+    dataset_pages = {dict_aliases.get(df_key, df_key): page for page, plot_names in dict_pdf_layout.items() for df_key in plot_names}
+    card_keys = normalise_symbols(gene_card_genes if gene_card_genes is not None else genes_of_interest).dropna().unique()
+    print('\n--- Drawing %i gene cards ---' %(len(card_keys)))
+    for gene_key in card_keys:
+        plot_gene_card(gene_key, df_gene_index, dataset_pages)
+    card_names = dict_pdf_layout['Gene cards']
+    n_card_pages = -(-len(card_names) // gene_cards_per_page)
+    if n_card_pages > 1: # One page of hundreds of cards would be far too large to render, so it is split in place
+        layout = list(dict_pdf_layout.items())
+        dict_pdf_layout.clear()
+        for page, plot_names in layout:
+            if page != 'Gene cards':
+                dict_pdf_layout[page] = plot_names
+                continue
+            for i in range(n_card_pages):
+                dict_pdf_layout['Gene cards (%i/%i)' %(i + 1, n_card_pages)] = card_names[i*gene_cards_per_page:(i + 1)*gene_cards_per_page]
 
 
 # =============================================================================
@@ -774,25 +2068,64 @@ for df_key in dict_df:
 import seaborn as sns
 import numpy as np
 
+# With more than one gene (and genes_per_grid set), the replicates of all genes are collected in one long dataframe (gene, Condition, Ys)
+# and drawn as small multiples: one seaborn call per figure of genes_per_grid genes, instead of one figure per gene.
+batch_replicate_plots = genes_per_grid > 0 and len(genes_of_interest) > 1
+
+def replicate_values(df, genes, samples, conditions):
+    '''Long dataframe with one row per gene (as named in genes) and replicate. conditions maps each sample column to its condition.'''
+    df_genes = pd.DataFrame({'gene': genes, 'gene_key': normalise_symbols(genes)}).dropna()
+    df_long = df[df['gene_key'].isin(df_genes['gene_key'])].melt(id_vars='gene_key', value_vars=samples, var_name='sample', value_name='Ys')
+    df_long['Condition'] = df_long['sample'].map(conditions)
+    return df_long.merge(df_genes, on='gene_key').dropna(subset=['Ys'])
+
+def replicate_grids(df_long, genes, order, ylabel, name, page):
+    '''Draws the replicates of genes (in that order) as grids of genes_per_grid small plots, and adds the figures to page of the pdf'''
+    for i in range(0, len(genes), genes_per_grid):
+        genes_grid = genes[i:i + genes_per_grid]
+        df_grid = df_long[df_long['gene'].isin(genes_grid)]
+        path_file_out = os.path.join(out_dir, '%s_%i.png' %(name, i//genes_per_grid + 1))
+        plot_path_list.append(path_file_out)
+        dict_pdf_layout[page].append(os.path.basename(path_file_out).split('.png')[0])
+        if df_grid.empty: # None of these genes were found: seaborn cannot draw a grid without data
+            plt.figure(figsize=(10,4))
+            plt.gcf().text(0.5, 0.5, '%s\nnot found in data' %('\n'.join(textwrap.wrap(', '.join(genes_grid), 80))), fontsize=12, ha='center', va='center', color='red')
+            print('%s plot failed for: %s' %(name, ', '.join(genes_grid)))
+            plt.savefig(path_file_out, dpi=150)
+            plt.show()
+            plt.close()
+            continue
+        sns.set(style="whitegrid", rc={"axes.grid": True, "grid.linestyle": "-"})
+        g = sns.catplot(data=df_grid, kind='strip', x='Condition', y='Ys', hue='Condition', order=order, hue_order=order, col='gene', col_order=genes_grid,
+                        col_wrap=min(5, len(genes_grid)), sharey=False, height=2.5, jitter=0.3, size=8, edgecolor='white', linewidth=1, legend=False)
+        g.map_dataframe(sns.boxplot, x='Condition', y='Ys', order=order, showmeans=True, meanline=True, meanprops={'color': 'k', 'ls': '-', 'lw': 1.5},
+                        medianprops={'visible': False}, whiskerprops={'visible': False}, zorder=10, showfliers=False, showbox=False, showcaps=False)
+        max_values = df_grid.groupby('gene')['Ys'].max()
+        for gene, ax in g.axes_dict.items():
+            if gene in max_values:
+                ax.set_ylim(0, max_values[gene]*1.2)
+            else:
+                ax.text(0.5, 0.5, 'not found in data', transform=ax.transAxes, ha='center', va='center', color='red')
+                ax.set_yticks([])
+                print('%s plot failed for: %s' %(name, gene))
+        g.set_titles('{col_name}')
+        g.set_axis_labels('', ylabel)
+        g.savefig(path_file_out, dpi=150)
+        plt.show()
+        plt.close()
+
 samples = ["CUTLL1.3nM.E7107.Rep1", "CUTLL1.3nM.E7107.Rep2", "CUTLL1.3nM.E7107.Rep3", "CUTLL1.3nM.E7107.5uM.NMDi.Rep1", "CUTLL1.3nM.E7107.5uM.NMDi.Rep2", "CUTLL1.3nM.E7107.5uM.NMDi.Rep3"]
 
+if batch_replicate_plots:
+    genes = sorted(str(protein).upper() for protein in genes_of_interest)
+    df_long = replicate_values(df_E7107_rescue, genes, samples, {sample: "E7107+NMDi" if "NMDi" in sample else "E7107" for sample in samples})
+    replicate_grids(df_long, genes, ["E7107", "E7107+NMDi"], 'counts', 'E7107_NMDi_rescue', 'E7107 and NMDi-associated gene expression changes (CUTLL1, 24h)')
 
-for protein in sorted(genes_of_interest):
+for protein in ([] if batch_replicate_plots else sorted(genes_of_interest)):
     protein = str(protein).upper()
-    ctrl_values = []
-    nmdi_values = []
-
-    for index, row in df_E7107_rescue.iterrows():
-        gene = str(row["gene"]).upper()
-        pval = row["adj.p"]
-        l2FC = row["logFC"]
-        
-        if gene == protein:
-            for sample in samples:
-                if "NMDi" in sample:
-                    nmdi_values.append(row[sample])
-                else:
-                    ctrl_values.append(row[sample])
+    rows = df_E7107_rescue[df_E7107_rescue['gene_key'] == normalise_symbols([protein])[0]]
+    ctrl_values = rows[[sample for sample in samples if "NMDi" not in sample]].values.ravel().tolist()
+    nmdi_values = rows[[sample for sample in samples if "NMDi" in sample]].values.ravel().tolist()
 
     plt.figure(figsize=(10,10))
     sns.set(style="whitegrid", rc={"axes.grid": True, "grid.linestyle": "-"})
@@ -857,25 +2190,17 @@ samples = {
     "E7107"    : [ "131N", "131C", "132N", "132C"]
     }
 
-for p in sorted(genes_of_interest):
+if batch_replicate_plots:
+    genes = sorted(str(protein).capitalize() for protein in genes_of_interest)
+    df_long = replicate_values(df_E7107_NW_MS, genes, [sample + ".1" for condition in samples for sample in samples[condition]],
+                               {sample + ".1": condition for condition in samples for sample in samples[condition]})
+    replicate_grids(df_long, genes, ["DMSO", "E7107"], 'Normalized relative\nabundance', 'E7107_MS', 'Proteomics on E7107 treatment - Data from Northwestern')
+
+for p in ([] if batch_replicate_plots else sorted(genes_of_interest)):
     p = str(p).capitalize()
     protein = p
-    values = {
-        "DMSO"     : [],
-        "E7107" : []
-        }
-    for index, row in df_E7107_NW_MS.iterrows():
-        try:
-            protein_desc = row["Protein Description"]
-            geneSymbol   = str(protein_desc.split("GN=")[1].split()[0]).capitalize()
-        except:
-            continue
-        if geneSymbol == protein:
-            for condition in samples:
-                for sample in samples[condition]:
-                    sample_ID = sample + ".1"
-                    value = row[sample_ID]
-                    values[condition].append(value)
+    rows = df_E7107_NW_MS[df_E7107_NW_MS['gene_key'] == normalise_symbols([protein])[0]]
+    values = {condition: rows[[sample + ".1" for sample in samples[condition]]].values.ravel().tolist() for condition in samples}
     _data = {
             "Ys" : np.concatenate([values["DMSO"], values["E7107"]]), 
             "Condition" : np.repeat(["DMSO", "E7107"], [len(values["DMSO"]), len(values["E7107"])])
@@ -944,6 +2269,10 @@ first_page_lines = [
     'Genes searched:',
     f'    {genes_sorted}'
     ]
+if gene_pattern_expansions:
+    first_page_lines += ['Gene patterns:'] + ['    %s -> %s (%i genes)' %(pattern, ' '.join(matches), len(matches)) for pattern, matches in gene_pattern_expansions.items()]
+if len(df_regions):
+    first_page_lines += ['Regions searched:'] + textwrap.wrap(', '.join(df_regions['name'].astype(str)), 150, initial_indent='    ', subsequent_indent='    ')
 
 print()
 print('--- Preparing pdf ---')
@@ -953,14 +2282,14 @@ def organize_plots_into_pages(plot_path_list, dict_pdf_layout):
     name_to_page = {}
     for page, plot_names in dict_pdf_layout.items():
         for name in plot_names:
-            name_to_page[name] = page
+            name_to_page[dict_aliases.get(name, name)] = page # Duplicate dataframes are plotted under the name of the one they are identical to
 
     # Group paths by page
     pages = defaultdict(list)
     for path in plot_path_list:
         # Extract plot name from the file path
         plot_name = os.path.basename(path).replace(".png", "")  # Assumes .png extension
-        if plot_name in name_to_page:
+        if plot_name in name_to_page and path not in pages[name_to_page[plot_name]]:
             page_key = name_to_page[plot_name]
             pages[page_key].append(path)
     return pages
@@ -1065,14 +2394,123 @@ else:
     print('PDF not requested')
 
 
+# =============================================================================
+# Generating an html report
+# =============================================================================
+# One html file that needs no network: the points of every dataframe are stored in the page as a small JSON block (see html_points)
+# that is only decoded and drawn on a canvas when its plot scrolls into view, so the report opens quickly however many dataframes it holds.
+# Hovering over a point shows its gene. The sections and their order follow dict_pdf_layout.
+
+html_template = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Interesting Lists</title>
+<style>
+body {font-family: sans-serif; margin: 0; display: flex}
+nav {position: sticky; top: 0; height: 100vh; overflow-y: auto; width: 260px; flex-shrink: 0; background: #f4f4f4; padding: 10px; box-sizing: border-box; font-size: 13px}
+nav a {display: block; color: #333; text-decoration: none; padding: 3px 0}
+main {padding: 10px 20px}
+h2 {border-bottom: 1px solid #ccc; padding-top: 10px}
+.plots {display: flex; flex-wrap: wrap; gap: 12px}
+figure {margin: 0; width: 380px}
+figcaption {font-size: 12px; word-break: break-all}
+canvas {width: 380px; height: 380px; border: 1px solid #ddd}
+#tip {position: fixed; pointer-events: none; background: #fff; border: 1px solid #888; padding: 2px 5px; font-size: 12px; display: none}
+</style></head>
+<body><nav><b>Interesting Lists</b><p>%(settings)s</p>%(nav)s</nav><main>%(sections)s</main><div id="tip"></div>
+%(data)s
+<script>
+const config = %(config)s;
+const tip = document.getElementById('tip');
+function floats(text) {
+  const bytes = Uint8Array.from(atob(text), c => c.charCodeAt(0));
+  return new Float32Array(bytes.buffer);
+}
+function draw(canvas) {
+  const d = JSON.parse(document.getElementById('data-' + canvas.dataset.i).textContent);
+  const x = floats(d.x), y = floats(d.y), n = x.length, size = 380, pad = 40, ratio = window.devicePixelRatio || 1;
+  canvas.width = size*ratio; canvas.height = size*ratio;
+  const ctx = canvas.getContext('2d'); ctx.scale(ratio, ratio);
+  let xmax = 0, ymax = 0;
+  for (let i = 0; i < n; i++) { if (isFinite(x[i])) xmax = Math.max(xmax, Math.abs(x[i])); if (isFinite(y[i])) ymax = Math.max(ymax, y[i]); }
+  if (d.type == 'DE_splicing') xmax = config.x_window;
+  xmax = xmax || 1; ymax = (ymax || 1)*1.1;
+  const px = v => pad + (v + xmax)/(2*xmax)*(size - 1.5*pad), py = v => size - pad - v/ymax*(size - 1.5*pad);
+  const tx = d.type == 'DE_splicing' ? config.thresh_PSI : config.thresh_l2FC;
+  ctx.strokeStyle = '#999'; ctx.beginPath();
+  ctx.moveTo(pad, size - pad); ctx.lineTo(size - pad/2, size - pad); ctx.moveTo(pad, size - pad); ctx.lineTo(pad, pad/2);
+  ctx.moveTo(px(tx), size - pad); ctx.lineTo(px(tx), pad/2); ctx.moveTo(px(-tx), size - pad); ctx.lineTo(px(-tx), pad/2);
+  ctx.moveTo(pad, py(config.thresh_y)); ctx.lineTo(size - pad/2, py(config.thresh_y)); ctx.stroke();
+  ctx.fillStyle = '#333'; ctx.font = '11px sans-serif'; ctx.textAlign = 'center';
+  ctx.fillText((-xmax).toPrecision(2), pad, size - pad + 14); ctx.fillText('0', px(0), size - pad + 14); ctx.fillText(xmax.toPrecision(2), size - pad/2, size - pad + 14);
+  ctx.fillText(d.type == 'DE_splicing' ? '\u0394PSI' : 'log2(Fold Change)', size/2, size - 8);
+  ctx.textAlign = 'right'; ctx.fillText(ymax.toPrecision(2), pad - 4, pad/2 + 4); ctx.fillText('0', pad - 4, size - pad);
+  const xs = new Float32Array(n), ys = new Float32Array(n);
+  for (let i = n - 1; i >= 0; i--) {
+    xs[i] = px(x[i]); ys[i] = py(y[i]);
+    ctx.fillStyle = i >= d.hits ? config.c_nint : (d.type == 'DE_splicing' ? config.AS_colors[d.events[i]] : config.c_inte);
+    ctx.beginPath(); ctx.arc(xs[i], ys[i], i >= d.hits ? 2 : 4, 0, 2*Math.PI); ctx.fill();
+  }
+  const labelled = [...Array(d.hits).keys()].sort((a, b) => Math.abs(x[b]) - Math.abs(x[a])).slice(0, config.max_labels);
+  ctx.fillStyle = '#000'; ctx.textAlign = 'left';
+  for (const i of labelled) ctx.fillText(d.labels[i], xs[i] + 5, ys[i] - 3);
+  ctx.textAlign = 'center'; ctx.fillText(d.hits + ' highlighted, ' + d.total + ' events', size/2, 12);
+  canvas.onmousemove = e => {
+    const r = canvas.getBoundingClientRect(), mx = e.clientX - r.left, my = e.clientY - r.top;
+    let best = -1, dist = 36;
+    for (let i = 0; i < n; i++) { const dd = (xs[i] - mx)**2 + (ys[i] - my)**2; if (dd < dist) { dist = dd; best = i; } }
+    if (best < 0) { tip.style.display = 'none'; return; }
+    tip.textContent = d.labels[best] + '  x=' + x[best].toPrecision(3) + '  -log10(p)=' + y[best].toPrecision(3);
+    tip.style.left = e.clientX + 12 + 'px'; tip.style.top = e.clientY + 12 + 'px'; tip.style.display = 'block';
+  };
+  canvas.onmouseleave = () => { tip.style.display = 'none'; };
+}
+const observer = new IntersectionObserver(entries => {
+  for (const entry of entries) if (entry.isIntersecting) { observer.unobserve(entry.target); draw(entry.target); }
+}, {rootMargin: '400px'});
+document.querySelectorAll('canvas').forEach(canvas => observer.observe(canvas));
+</script></body></html>
+'''
+
+def write_html_report(path, dict_html, dict_pdf_layout):
+    # Dataframes in the order of the pages of the pdf (under the name they were scanned as), then any that are on no page
+    pages = {}
+    for page, plot_names in dict_pdf_layout.items():
+        df_keys = [df_key for df_key in dict.fromkeys(dict_aliases.get(name, name) for name in plot_names) if df_key in dict_html]
+        if df_keys:
+            pages[page] = df_keys
+    on_pages = {df_key for df_keys in pages.values() for df_key in df_keys}
+    others = [df_key for df_key in dict_html if df_key not in on_pages]
+    if others:
+        pages['Other dataframes'] = others
+
+    nav, sections, data, i = [], [], [], 0
+    for n_page, (page, df_keys) in enumerate(pages.items()):
+        nav.append('<a href="#page-%i">%s</a>' %(n_page, html.escape(page)))
+        figures = []
+        for df_key in df_keys:
+            figures.append('<figure><canvas data-i="%i"></canvas><figcaption>%s</figcaption></figure>' %(i, html.escape(df_key)))
+            data.append('<script type="application/json" id="data-%i">%s</script>' %(i, json.dumps(dict_html[df_key]).replace('</', '<\\/')))
+            i += 1
+        sections.append('<h2 id="page-%i">%s</h2><div class="plots">%s</div>' %(n_page, html.escape(page), ''.join(figures)))
+
+    config = {'c_inte': c_inte, 'c_nint': c_nint, 'AS_colors': AS_colors, 'x_window': x_window, 'max_labels': max_labels,
+              'thresh_PSI': thresh_PSI, 'thresh_l2FC': thresh_l2FC, 'thresh_y': -math.log10(thresh_pval)}
+    settings = 'Genes searched: %s<br>pval &lt;%s, FDR &lt;%s, |dPSI| &ge;%s, |l2FC| &ge;%s' %(html.escape(' '.join(sorted(map(str, genes_of_interest)))), thresh_pval, thresh_FDR, thresh_PSI, thresh_l2FC)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(html_template %{'settings': settings, 'nav': ''.join(nav), 'sections': ''.join(sections), 'data': '\n'.join(data), 'config': json.dumps(config)})
+
+if make_html:
+    write_html_report(path_html, dict_html, dict_pdf_layout)
+    print(f"HTML report saved as {path_html}")
+
+
 #%% To satisfy the curious, this section prints out the genes that appear the most across all scanned dataframes
 thresh_appearance_fraction = 4 # A gene must appear in at least 1 in every n dataframes to be considered a frequent hit
-thresh_appearances = math.ceil(len(dict_df)/thresh_appearance_fraction) #How many dataframes must a gene have been seen in before it is interesting?
+n_dataframes = len(dict_df) - len(dict_aliases) # Duplicate dataframes are not counted twice
+thresh_appearances = math.ceil(n_dataframes/thresh_appearance_fraction) #How many dataframes must a gene have been seen in before it is interesting?
 frequent_genes = [key for key, value in appearances.items() if value >= thresh_appearances]
 frequent_genes_sorted = sorted(frequent_genes, key=lambda k: appearances[k], reverse=True)
-frequent_genes_sorted.remove('NAN')
 print()
-print("Genes found %i or more times in the %i dataframes:" %(thresh_appearances, len(dict_df)))
+print("Genes found %i or more times in the %i dataframes:" %(thresh_appearances, n_dataframes))
 for gene in frequent_genes_sorted:
     print(gene, appearances[gene])
 